@@ -0,0 +1,362 @@
+"""Synthetic databases and a benchmark of the tool.py commands on them.
+
+The generated database follows the Django schema of models.py and is fully determined by its scale
+and seed, so results of different commits are comparable. Every scenario runs ``tool.py`` in a child
+process of its own, which reports its peak RSS (Linux VmHWM) when it exits. The startup cost of
+``tool.py -h`` and of an hourly export is measured apart, against a bare interpreter start.
+"""
+import collections
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from peewee import SqliteDatabase
+from models import database_proxy, ShopArea, ShopFloor, ShopCamera, ShopRectangle, HeatmapHeatvalue, \
+    HeatmapStayvalue, FlowFlow, PeoplePerson, HeatmapHeatmapreport, HeatmapStaymapreport, FlowFlowreport, \
+    PeoplePeoplereport
+
+log = logging
+
+TOOL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tool.py')
+MODELS = [ShopArea, ShopFloor, ShopCamera, ShopRectangle, HeatmapHeatvalue, HeatmapStayvalue, FlowFlow, PeoplePerson,
+          HeatmapHeatmapreport, HeatmapStaymapreport, FlowFlowreport, PeoplePeoplereport]
+RAW_MODELS = [HeatmapHeatvalue, HeatmapStayvalue, FlowFlow, PeoplePerson]
+START = datetime.datetime(2017, 12, 1)
+# Flow and people values are much rarer than heat and stay values.
+SPARSE_RATIO = 10
+DELETED_RATIO = 0.001
+
+# The ru_maxrss of a child starts at the high water mark of the parent it was forked from,
+# so each child reports its own VmHWM when it exits.
+PEAK_RSS_WRAPPER = '''
+import atexit, os, runpy, sys
+
+def _peak():
+    with open('/proc/self/status') as status, open(os.environ['BENCH_PEAK_FILE'], 'w') as out:
+        out.write(next(line.split()[1] for line in status if line.startswith('VmHWM:')))
+
+atexit.register(_peak)
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(sys.argv[0]))
+runpy.run_path(sys.argv[0], run_name='__main__')
+'''
+
+Scenario = collections.namedtuple('Scenario', ['name', 'argv', 'rows', 'output'])
+
+STARTUP_RUNS = 10
+# Seconds -h and an hourly export may take beyond a bare interpreter start, they run many times per hour from cron.
+STARTUP_BUDGET = 0.1
+# Timer noise allowed on top of the tolerance when comparing startups.
+STARTUP_SLACK = 0.005
+
+
+def _uuid(rnd):
+    return uuid.UUID(int=rnd.getrandbits(128), version=4).hex
+
+
+def create_schema(path):
+    """Create the tables used by the tool, with the foreign key indexes Django makes, in a new database."""
+    database = SqliteDatabase(path)
+    database_proxy.initialize(database)
+    database.create_tables(MODELS, safe=True)
+    database.close()
+
+
+def _insert(database, model, rows):
+    columns = [f.db_column for f in model._meta.sorted_fields]
+    sql = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+        model._meta.db_table, ', '.join('"{}"'.format(c) for c in columns), ', '.join('?' * len(columns)))
+    database.get_cursor().executemany(sql, ([row[c] for c in columns] for row in rows))
+
+
+def _values(rnd, count, days, make):
+    """``count`` raw rows spread evenly over ``days`` in time order, ``make`` filling in the table columns."""
+    step = datetime.timedelta(days=days) / max(count, 1)
+    for i in range(count):
+        t = START + step * i
+        deleted = rnd.random() < DELETED_RATIO
+        row = {'id': _uuid(rnd), 'time': str(t), 'created': str(t), 'updated': str(t), 'is_deleted': int(deleted),
+               'deleted_time': str(t + datetime.timedelta(hours=1)) if deleted else None}
+        row.update(make())
+        yield row
+
+
+def generate(path, rows=100000, areas=10, rects=50, days=7, seed=0):
+    """Write a synthetic database to ``path``.
+
+    Args:
+        path: New sqlite file.
+        rows: Heat values, and as many stay values. Flow and people get a tenth of it.
+        areas: Number of shop areas.
+        rects: Number of rectangles, spread over the areas, 5 per camera and 10 cameras per floor.
+        days: Days the values cover, from ``START``.
+        seed: Seed of the random values.
+    """
+    rnd = random.Random(seed)
+    create_schema(path)
+    database = SqliteDatabase(path, pragmas=[('journal_mode', 'off'), ('synchronous', 'off')])
+    database_proxy.initialize(database)
+    now = str(START)
+    common = {'created': now, 'updated': now, 'is_deleted': 0, 'deleted_time': None}
+    with database.atomic():
+        area_ids = [_uuid(rnd) for _ in range(areas)]
+        _insert(database, ShopArea, (dict(common, id=a, category=1, name='area {}'.format(i))
+                                     for i, a in enumerate(area_ids)))
+        camera_ids = [_uuid(rnd) for _ in range((rects + 4) // 5)]
+        floor_ids = [_uuid(rnd) for _ in range((len(camera_ids) + 9) // 10)]
+        _insert(database, ShopFloor, (dict(common, id=f, building='b', name='floor {}'.format(i), plan=None,
+                                           ratio=1.0) for i, f in enumerate(floor_ids)))
+        _insert(database, ShopCamera, (dict(common, id=c, background=None, category=1, enable=1,
+                                            floor_id=floor_ids[i // 10], floor_x=(i % 10) * 640.0, floor_y=0.0,
+                                            w=640, h=480, ip='', mac='', name='camera {}'.format(i), ratio=1.0,
+                                            rtsp='') for i, c in enumerate(camera_ids)))
+        shapes = []
+        for i in range(rects):
+            w, h = rnd.randint(10, 40), rnd.randint(10, 40)
+            shapes.append((_uuid(rnd), w, h))
+        _insert(database, ShopRectangle, (dict(common, id=r, area_id=area_ids[i % areas], camera_id=camera_ids[i // 5],
+                                               x=rnd.randrange(640 - w), y=rnd.randrange(480 - h), w=w, h=h)
+                                          for i, (r, w, h) in enumerate(shapes)))
+
+    def point(value):
+        def make():
+            rect, w, h = rnd.choice(shapes)
+            return {'rect_id': rect, 'x': rnd.randrange(w), 'y': rnd.randrange(h), value: rnd.randrange(1, 20)}
+        return make
+
+    makers = [
+        (HeatmapHeatvalue, rows, point('hot')),
+        (HeatmapStayvalue, rows, point('stay')),
+        (FlowFlow, rows // SPARSE_RATIO,
+         lambda: {'area_id': rnd.choice(area_ids), 'flow_in': rnd.randrange(10), 'flow_out': rnd.randrange(10)}),
+        (PeoplePerson, rows // SPARSE_RATIO,
+         lambda: {'area_id': rnd.choice(area_ids), 'age': rnd.randrange(5, 80), 'gender': rnd.randrange(2)}),
+    ]
+    for model, count, make in makers:
+        with database.atomic():
+            _insert(database, model, _values(rnd, count, days, make))
+        log.info('{} {} rows generated'.format(count, model._meta.db_table))
+    database.close()
+
+
+def _size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def _run(scenario, workdir):
+    """Run a scenario in a child process and measure it."""
+    log.info('running {}'.format(scenario.name))
+    peak_file = os.path.join(workdir, scenario.name + '.peak')
+    with open(os.path.join(workdir, scenario.name + '.log'), 'w+') as err:
+        started = time.perf_counter()
+        process = subprocess.Popen([sys.executable, '-c', PEAK_RSS_WRAPPER, TOOL, '-l', 'warning'] +
+                                   [arg() if callable(arg) else arg for arg in scenario.argv],
+                                   stdout=subprocess.DEVNULL, stderr=err,
+                                   env=dict(os.environ, BENCH_PEAK_FILE=peak_file))
+        process.wait()
+        seconds = time.perf_counter() - started
+        if process.returncode:
+            err.seek(0)
+            raise RuntimeError('{} failed:\n{}'.format(scenario.name, err.read()[-2000:]))
+    with open(peak_file) as f:
+        peak = int(f.read()) * 1024
+    return {
+        'rows': scenario.rows,
+        'seconds': round(seconds, 3),
+        'rows_per_sec': round(scenario.rows / seconds),
+        'peak_rss_bytes': peak,
+        'output_bytes': _size(scenario.output) if scenario.output else None,
+    }
+
+
+def _count(path, start=None, end=None):
+    connection = sqlite3.connect(path)
+    where, params = '', []
+    if start is not None:
+        where, params = ' WHERE "time" >= ? AND "time" < ?', [str(start), str(end)]
+    total = sum(connection.execute('SELECT COUNT(*) FROM "{}"{}'.format(m._meta.db_table, where), params).fetchone()[0]
+                for m in RAW_MODELS)
+    connection.close()
+    return total
+
+
+def _rolled_up(path, start, end):
+    """Raw rows a rollup of ``[start, end)`` aggregates: the live ones, of a rectangle with an area for heat and stay."""
+    connection = sqlite3.connect(path)
+    total = 0
+    for m in RAW_MODELS:
+        join = ''
+        if hasattr(m, 'rect'):
+            join = ' JOIN "{}" r ON r."id" = v."{}" AND r."area_id" IS NOT NULL'.format(
+                ShopRectangle._meta.db_table, m.rect.db_column)
+        total += connection.execute(
+            'SELECT COUNT(*) FROM "{}" v{} WHERE v."time" >= ? AND v."time" < ? AND NOT v."is_deleted"'.format(
+                m._meta.db_table, join), [str(start), str(end)]).fetchone()[0]
+    connection.close()
+    return total
+
+
+def _scenarios(workdir, source, days, fmt):
+    first = START.strftime('%Y-%m-%d')
+    last = (START + datetime.timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    total = _count(source)
+    dump = os.path.join(workdir, 'dump')
+
+    def dumped():
+        # export-full writes a single <run time> folder.
+        return os.path.join(dump, os.listdir(dump)[0])
+
+    imported, fast, copied = [os.path.join(workdir, n) for n in ['import.db', 'import-fast.db', 'copy.db']]
+    for path in [imported, fast, copied]:
+        create_schema(path)
+    return [
+        Scenario('index', ['index', '--create', '--sqlite', source], total, None),
+        Scenario('export-day', ['export', '--sqlite', source, '-d', first, '-f', fmt, '-o',
+                                os.path.join(workdir, 'day')],
+                 _count(source, START, START + datetime.timedelta(days=1)), os.path.join(workdir, 'day')),
+        Scenario('export-range', ['export', '--sqlite', source, '--from', first, '--to', last, '-f', fmt, '-o',
+                                  os.path.join(workdir, 'range')], total, os.path.join(workdir, 'range')),
+        Scenario('export-full', ['export', '--sqlite', source, '--incremental', os.path.join(workdir, 'state.json'),
+                                 '-f', fmt, '-o', dump], total, dump),
+        Scenario('import', ['import', '--sqlite', imported, '-i', dumped], total, imported),
+        Scenario('import-fast', ['import', '--sqlite', fast, '--fast-load', '-i', dumped], total, fast),
+        Scenario('copy', ['copy', '--sqlite', source, '--target', copied, '--from', first, '--to', last], total, copied),
+        # The copy holds no rectangles, rollup joins the values to them.
+        Scenario('rollup', ['rollup', '--sqlite', source, '--from', first, '--to', last],
+                 _rolled_up(source, START, START + datetime.timedelta(days=days)), source),
+    ]
+
+
+def _median_seconds(argv, runs):
+    """Median wall time of ``runs`` runs of ``argv``, after a first run that writes the bytecode caches."""
+    seconds = []
+    for _ in range(runs + 1):
+        started = time.perf_counter()
+        subprocess.check_call(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        seconds.append(time.perf_counter() - started)
+    return statistics.median(seconds[1:])
+
+
+def _startup(workdir, source, runs=STARTUP_RUNS):
+    """Seconds ``tool.py -h`` and the export of an hour take beyond starting a bare interpreter."""
+    log.info('running startup')
+    # As cron finds the database: indexed, and with the column registry written by an earlier command.
+    subprocess.check_call([sys.executable, TOOL, '-l', 'warning', 'index', '--create', '--sqlite', source])
+    python = _median_seconds([sys.executable, '-c', 'pass'], runs)
+    results = {'python_seconds': round(python, 4)}
+    for name, argv in [('help', ['-h']),
+                       ('export-hour', ['-l', 'warning', 'export', '--sqlite', source, '-d', START.strftime('%Y-%m-%d'),
+                                        '-t', '12', '-o', os.path.join(workdir, 'hour')])]:
+        results[name] = round(_median_seconds([sys.executable, TOOL] + argv, runs) - python, 4)
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(TOOL),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(rows=100000, areas=10, rects=50, days=7, seed=0, fmt='csv', database=None, workdir=None, only=None):
+    """Generate or reuse a synthetic database and run the scenarios on a copy of it.
+
+    Args:
+        rows, areas, rects, days, seed: Scale of the database, see ``generate()``.
+        fmt: Export format, one of ``options.FORMATS``.
+        database: Keep the generated database in this file, and reuse it when it exists.
+        workdir: Keep the files of the scenarios in this directory. A temporary one is removed afterwards.
+        only: Names of the scenarios to run, ``startup`` for the startup times. Default is all of them.
+            The imports read what export-full wrote.
+
+    Returns:
+        Dict of the environment, the scale and the measures of each scenario.
+    """
+    scale = {'rows': rows, 'areas': areas, 'rects': rects, 'days': days, 'seed': seed}
+    keep = workdir is not None
+    workdir = workdir or tempfile.mkdtemp(prefix='bench-')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        generate_seconds = None
+        if database is None or not os.path.exists(database):
+            path = database or os.path.join(workdir, 'generated.db')
+            started = time.perf_counter()
+            generate(path, **scale)
+            generate_seconds = round(time.perf_counter() - started, 3)
+            database = path
+        source = os.path.join(workdir, 'source.db')
+        shutil.copyfile(database, source)
+        results = {}
+        for scenario in _scenarios(workdir, source, days, fmt):
+            if only and scenario.name not in only:
+                continue
+            results[scenario.name] = _run(scenario, workdir)
+        startup = _startup(workdir, source) if not only or 'startup' in only else None
+        return {
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'scale': scale,
+            'format': fmt,
+            'database_bytes': os.path.getsize(database),
+            'generate_seconds': generate_seconds,
+            'scenarios': results,
+            'startup': startup,
+        }
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Scenarios slower or larger in memory than ``baseline`` by more than ``tolerance``.
+
+    Startups are also checked against ``STARTUP_BUDGET``, whatever the baseline.
+
+    Returns:
+        List of messages, empty when nothing regressed.
+    """
+    regressions = []
+    startup = results.get('startup') or {}
+    for name in ['help', 'export-hour']:
+        if startup.get(name, 0) > STARTUP_BUDGET:
+            regressions.append('{}: starts in {:.0f} ms over a bare interpreter, the budget is {:.0f} ms'.format(
+                name, startup[name] * 1e3, STARTUP_BUDGET * 1e3))
+    if results['scale'] != baseline['scale'] or results['format'] != baseline['format']:
+        log.warning('baseline was measured at {} {}, not comparable'.format(baseline['scale'], baseline['format']))
+        return regressions
+    before_startup = baseline.get('startup') or {}
+    for name in ['help', 'export-hour']:
+        if name in startup and name in before_startup and \
+                startup[name] > before_startup[name] * (1 + tolerance) + STARTUP_SLACK:
+            regressions.append('{}: starts in {:.0f} ms over a bare interpreter, was {:.0f} ms'.format(
+                name, startup[name] * 1e3, before_startup[name] * 1e3))
+    for name, now in sorted(results['scenarios'].items()):
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+        if now['rows_per_sec'] < before['rows_per_sec'] * (1 - tolerance):
+            regressions.append('{}: {} rows/sec, was {}'.format(name, now['rows_per_sec'], before['rows_per_sec']))
+        if now['peak_rss_bytes'] > before['peak_rss_bytes'] * (1 + tolerance):
+            regressions.append('{}: peak RSS {} bytes, was {}'.format(name, now['peak_rss_bytes'],
+                                                                      before['peak_rss_bytes']))
+    return regressions
+
+
+def save(file, results):
+    with open(file, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,2716 @@
+"""The commands of tool.py, run by ``run()`` once the command line is parsed."""
+import csv
+import logging
+import json
+import os
+import sys
+import itertools
+import functools
+import operator
+import contextlib
+import time
+import atexit
+import io
+import mmap
+import shutil
+import signal
+import sqlite3
+import gzip
+import hashlib
+import struct
+import threading
+import importlib
+import datetime
+import decimal
+import collections
+import concurrent.futures
+from queue import Empty, Queue
+from peewee import SqliteDatabase, ForeignKeyField, DateTimeField, BooleanField, IntegerField, FloatField, \
+    DecimalField
+import models
+import registry
+from models import database_proxy, BaseModel, HeatmapHeatvalue, HeatmapStayvalue, FlowFlow, PeoplePerson, ShopRectangle, \
+    HeatmapHeatmapreport, HeatmapStaymapreport, FlowFlowreport, PeoplePeoplereport, ProductProductreport
+from common import METRICS, MANIFEST, SHARD_SUFFIX, CsvWriter, _configure, _require, _open_text, _table_file, \
+    _makedirs, _time_range, _load_state, _save_state, _save_manifest, _checksum, _readonly_uri, _export_raw
+from options import CMDS, DEFAULT_SQLITE_FILE, FORMATS, COLUMNAR_FORMATS, PARTITIONS, FOLLOW_POLL, FOLLOW_LIMIT, \
+    FOLLOW_ROTATE, FOLLOW_LAG, COMPACT_BATCH_SIZE
+
+log = logging
+
+
+class DateTimeEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, datetime.datetime):
+            return obj.isoformat()
+        elif isinstance(obj, datetime.date):
+            return obj.isoformat()
+        elif isinstance(obj, datetime.timedelta):
+            return (datetime.datetime.min + obj).time().isoformat()
+        else:
+            return super(DateTimeEncoder, self).default(obj)
+
+
+# Columnar files keep timestamps as int64 microseconds since EPOCH. npz has no nulls, so NULL_EPOCH stands for None.
+EPOCH = datetime.datetime(1970, 1, 1)
+NULL_EPOCH = -2 ** 63
+ROW_GROUP_SIZE = 65536
+# numpy dtype of each column kind in npz files.
+NUMPY_TYPES = {'dictionary': 'int32', 'epoch': 'int64', 'bool': 'bool', 'int': 'int64', 'float': 'float64',
+               'decimal': 'str', 'str': 'str'}
+
+
+def _resolve_format(fmt):
+    """Map ``columnar`` to parquet when pyarrow is installed and to npz otherwise."""
+    if fmt != 'columnar':
+        return fmt
+    try:
+        importlib.import_module('pyarrow.parquet')
+        return 'parquet'
+    except ImportError:
+        return 'npz'
+
+
+def _detect_format(folder, tables=None):
+    """Format of the exported files of ``tables`` in ``folder``, csv when none is found."""
+    for fmt in FORMATS:
+        if any(os.path.exists(_table_file(folder, t.name, fmt)) for t in tables or TABLES):
+            return fmt
+    return 'csv'
+
+
+def _column_kinds(model, fieldnames):
+    """How each column is stored in a columnar file."""
+    kinds = []
+    for name in fieldnames:
+        field = model._meta.fields[name]
+        if isinstance(field, ForeignKeyField):
+            # Only text keys repeat long enough values to gain from a dictionary.
+            kinds.append('int' if isinstance(field.to_field, IntegerField) else 'dictionary')
+        elif isinstance(field, DateTimeField):
+            kinds.append('epoch')
+        elif isinstance(field, BooleanField):
+            kinds.append('bool')
+        elif isinstance(field, IntegerField):
+            kinds.append('int')
+        elif isinstance(field, FloatField):
+            kinds.append('float')
+        elif isinstance(field, DecimalField):
+            kinds.append('decimal')
+        else:
+            kinds.append('str')
+    return kinds
+
+
+def _to_epoch(dt):
+    return None if dt is None else (dt - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+class ColumnarWriter(object):
+    """Writes record dicts to a typed parquet or npz file.
+
+    Text foreign keys such as ``rect`` and ``area`` are dictionary encoded, timestamps are
+    stored as int64 epoch microseconds and decimals as text. Parquet is written one row group at a time;
+    npz keeps the compact column arrays until the file is closed. npz stores NULL keys as the code -1,
+    and the NULLs of other columns in a ``<name>_null`` mask, written when the column has any.
+    """
+
+    def __init__(self, file, model, fieldnames, fmt='parquet'):
+        self.name = file
+        self._fmt = fmt
+        self._fieldnames = list(fieldnames)
+        self._kinds = _column_kinds(model, fieldnames)
+        self._rows = []
+        if fmt == 'parquet':
+            self._pa = _require('pyarrow', fmt)
+            self._pq = _require('pyarrow.parquet', fmt)
+            pa = self._pa
+            types = {'dictionary': pa.dictionary(pa.int32(), pa.string()), 'epoch': pa.int64(), 'bool': pa.bool_(),
+                     'int': pa.int64(), 'float': pa.float64(), 'decimal': pa.string(), 'str': pa.string()}
+            self._schema = pa.schema([(n, types[k]) for n, k in zip(self._fieldnames, self._kinds)])
+            self._parquet = self._pq.ParquetWriter(file, self._schema, compression='zstd')
+        else:
+            self._np = _require('numpy', fmt)
+            self._chunks = []
+            self._codes = {n: {None: -1} for n, k in zip(self._fieldnames, self._kinds) if k == 'dictionary'}
+
+    def writerow(self, record):
+        self._rows.append([record[n] for n in self._fieldnames])
+        if len(self._rows) >= ROW_GROUP_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self._rows:
+            return
+        columns = list(zip(*self._rows))
+        self._rows = []
+        if self._fmt == 'parquet':
+            self._parquet.write_batch(self._pa.record_batch(
+                [self._parquet_column(v, k, t) for v, k, t in zip(columns, self._kinds, self._schema.types)],
+                schema=self._schema))
+        else:
+            self._chunks.append([self._numpy_column(n, v, k) for n, v, k in zip(self._fieldnames, columns, self._kinds)])
+
+    def _parquet_column(self, values, kind, type):
+        pa = self._pa
+        if kind == 'dictionary':
+            return pa.array(values, pa.string()).dictionary_encode().cast(type)
+        if kind == 'epoch':
+            values = [_to_epoch(v) for v in values]
+        elif kind == 'decimal':
+            values = [None if v is None else str(v) for v in values]
+        return pa.array(values, type)
+
+    def _numpy_column(self, name, values, kind):
+        """The column as an array, and its NULL mask, or None without NULLs."""
+        np = self._np
+        if kind == 'dictionary':
+            codes = self._codes[name]
+            # None holds the code -1, values get the codes from 0.
+            return np.array([codes.setdefault(v, len(codes) - 1) for v in values], dtype=np.int32), None
+        if kind == 'epoch':
+            return np.array([NULL_EPOCH if v is None else _to_epoch(v) for v in values], dtype=np.int64), None
+        nulls = None
+        if None in values:
+            nulls = np.array([v is None for v in values], dtype=np.bool_)
+            fill = {'bool': False, 'int': 0, 'float': 0.0, 'decimal': '', 'str': ''}[kind]
+            values = [fill if v is None else v for v in values]
+        if kind == 'decimal':
+            values = [str(v) for v in values]
+        return np.array(values, dtype=NUMPY_TYPES[kind]), nulls
+
+    def close(self):
+        self._flush()
+        if self._fmt == 'parquet':
+            self._parquet.close()
+            return
+        np = self._np
+        arrays = {}
+        for i, (name, kind) in enumerate(zip(self._fieldnames, self._kinds)):
+            parts = [chunk[i] for chunk in self._chunks]
+            if parts:
+                arrays[name] = np.concatenate([column for column, _ in parts])
+            else:
+                arrays[name] = np.array([], dtype=NUMPY_TYPES[kind])
+            if any(nulls is not None for _, nulls in parts):
+                arrays[name + '_null'] = np.concatenate([np.zeros(len(column), dtype=np.bool_) if nulls is None else nulls
+                                                         for column, nulls in parts])
+            if kind == 'dictionary':
+                arrays[name + '_dictionary'] = np.array([v for v in self._codes[name] if v is not None], dtype=np.str_)
+        # Keep the column order of the file, np.load() does not guarantee it otherwise.
+        arrays['_fieldnames'] = np.array(self._fieldnames, dtype=np.str_)
+        with open(self.name, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _open_writer(file, model, fieldnames, fmt='csv'):
+    if isinstance(file, StreamWriter):
+        return file.section(model, fieldnames)
+    if fmt in COLUMNAR_FORMATS:
+        return ColumnarWriter(file, model, fieldnames, fmt)
+    return CsvWriter(file, model, fieldnames, fmt)
+
+
+def _parquet_values(column, kind):
+    # Both are much faster than to_pylist() on timestamp and dictionary arrays.
+    if kind == 'epoch':
+        return column.fill_null(NULL_EPOCH).to_numpy().astype('datetime64[us]').tolist()
+    if kind == 'dictionary':
+        dictionary = column.dictionary.to_pylist()
+        return [None if i is None else dictionary[i] for i in column.indices.to_pylist()]
+    return column.to_pylist()
+
+
+def _read_columnar(file, model, fmt='parquet'):
+    """Lazily read the rows of a parquet or npz file as insertable dicts.
+
+    Epoch columns are turned back into datetimes by numpy casts, a batch at a time.
+    """
+    if fmt == 'parquet':
+        parquet_file = _require('pyarrow.parquet', fmt).ParquetFile(file)
+        fieldnames = parquet_file.schema_arrow.names
+        kinds = _column_kinds(model, fieldnames)
+        batches = ([_parquet_values(c, k) for c, k in zip(batch.columns, kinds)]
+                   for batch in parquet_file.iter_batches(batch_size=ROW_GROUP_SIZE))
+    else:
+        np = _require('numpy', fmt)
+        data = np.load(file)
+        fieldnames = data['_fieldnames'].tolist()
+        kinds = _column_kinds(model, fieldnames)
+        columns = []
+        for name, kind in zip(fieldnames, kinds):
+            column = data[name]
+            if name + '_dictionary' in data.files:
+                # The code -1 of NULL picks the None appended to the dictionary.
+                column = np.append(data[name + '_dictionary'].astype(object), None)[column]
+            elif kind == 'epoch':
+                # NULL_EPOCH is numpy's NaT, which tolist() gives back as None.
+                column = column.astype('datetime64[us]')
+            if name + '_null' in data.files:
+                column = column.astype(object)
+                column[data[name + '_null']] = None
+            columns.append(column)
+        size = len(columns[0]) if columns else 0
+        batches = ([column[i:i + ROW_GROUP_SIZE].tolist() for column in columns]
+                   for i in range(0, size, ROW_GROUP_SIZE))
+    keys = tuple(fieldnames)
+    for batch in batches:
+        for values in zip(*batch):
+            yield dict(zip(keys, values))
+
+
+def _raw_columns(model, fieldnames):
+    """Select list of ``fieldnames`` giving the values as the csv holds them.
+
+    Stored text such as timestamps is read unchanged, only booleans are spelled out as ``True``/``False``.
+    """
+    columns = []
+    for name in fieldnames:
+        field = model._meta.fields[name]
+        column = '"{}"'.format(field.db_column)
+        if isinstance(field, BooleanField):
+            column = 'CASE WHEN {0} IS NULL THEN NULL WHEN {0} THEN \'True\' ELSE \'False\' END'.format(column)
+        columns.append(column)
+    return ', '.join(columns)
+
+
+def _export_csv(file, model, fields, date, hour=None, fmt='csv'):
+    """Export the rows of a day or hour of ``model``, or all its rows when it has no time column.
+
+    Csv formats are written by ``common._export_raw()``, as ``tool.py`` writes them from the registry.
+    Columnar formats go through typed peewee dicts.
+
+    Args:
+        file: Path of the file, or a ``StreamWriter``.
+        model: Model to export.
+        fields: Names of the fields to write, in order.
+        date: datetime of the day to export.
+        hour: Optional hour of the day.
+        fmt: One of ``FORMATS``.
+
+    Returns:
+        Number of rows written.
+    """
+    field = _time_field(model)
+    table = model._meta.db_table
+    if fmt not in COLUMNAR_FORMATS:
+        return _export_raw(database_proxy.execute_sql, file, functools.partial(_open_writer, file, model, fields, fmt),
+                           model.__name__, table, _raw_columns(model, fields), field and field.db_column, date, hour)
+    if field is None:
+        log.info('start export from {0}. no time column, all rows'.format(model.__name__))
+    else:
+        log.info('start export from {0}. filter date {1} hour {2}'.format(model.__name__, date.date(), hour))
+        start, end = _time_range(date, hour)
+
+    log.info('generating {0}'.format(file))
+
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    count = 0
+    with _open_writer(file, model, fields, fmt) as writer:
+        query = model.select().dicts()
+        if field is not None:
+            query = query.where((field >= start) & (field < end))
+        write = METRICS.timed_call(writer.writerow, table, 'write')
+        with METRICS.timer(table, 'query'):
+            records = query.execute()
+        for record in METRICS.timed(records, table, 'fetch'):
+            count += 1
+            if debug and count % 1000 == 1:
+                log.debug('{}: {}'.format(count, json.dumps(record, cls=DateTimeEncoder)[0:120]))
+            write(record)
+    log.info('{} exported'.format(count))
+    return count
+
+
+Table = collections.namedtuple('Table', ['name', 'model', 'fieldnames'])
+
+
+def _time_field(model):
+    """The column exports of a day or range select on: ``time``, ``hour`` of reports, or None."""
+    for name in ('time', 'hour'):
+        field = model._meta.fields.get(name)
+        if isinstance(field, DateTimeField):
+            return field
+    return None
+
+
+def _typed_fields(model):
+    """Mapping of type to the names of the fields of ``model`` parsed as it, such as ``{int: {'x', 'y'}}``.
+
+    Nullable text and foreign key fields are listed under ``str``, so that empty values become None.
+    """
+    typed = collections.defaultdict(set)
+    for field in model._meta.sorted_fields:
+        t = None
+        if not isinstance(field, ForeignKeyField):
+            t = next((t for field_type, t in FIELD_TYPES if isinstance(field, field_type)), None)
+        if t is None and field.null:
+            t = str
+        if t is not None:
+            typed[t].add(field.name)
+    return dict(typed)
+
+
+def _model_table(model, name=None):
+    """Describe ``model`` as a Table, the primary key first and the other columns in peewee's field order."""
+    pk = model._meta.primary_key
+    fieldnames = [pk.name] + [f.name for f in model._meta.sorted_fields if f is not pk]
+    return Table(name or model._meta.db_table, model, fieldnames)
+
+
+# Subclasses come before their bases: BooleanField is not an IntegerField, but PrimaryKeyField is.
+FIELD_TYPES = [
+    (DateTimeField, datetime.datetime),
+    (BooleanField, bool),
+    (IntegerField, int),
+    (FloatField, float),
+    (DecimalField, decimal.Decimal),
+]
+
+# The raw value tables keep the csv columns they have always been exported with.
+TABLES = [
+    Table('heatmap', HeatmapHeatvalue,
+          ['id', 'rect', 'x', 'y', 'time', 'hot', 'created', 'updated', 'is_deleted', 'deleted_time']),
+    Table('staymap', HeatmapStayvalue,
+          ['id', 'rect', 'x', 'y', 'time', 'stay', 'created', 'updated', 'is_deleted', 'deleted_time']),
+    Table('flow', FlowFlow,
+          ['id', 'area', 'time', 'flow_in', 'flow_out', 'created', 'updated', 'is_deleted', 'deleted_time']),
+    Table('people', PeoplePerson,
+          ['id', 'area', 'time', 'age', 'gender', 'created', 'updated', 'is_deleted', 'deleted_time']),
+]
+
+# Every model of models.py with a primary key, the raw value tables under their short names.
+ALL_TABLES = [next((t for t in TABLES if t.model is model), None) or _model_table(model)
+              for model in vars(models).values()
+              if isinstance(model, type) and issubclass(model, BaseModel) and model is not BaseModel
+              and model._meta.primary_key]
+
+
+def _dependency_order(tables):
+    """Sort ``tables`` so that every table comes after the tables its foreign keys point to."""
+    pending = list(tables)
+    models_left = {t.model for t in pending}
+    ordered = []
+    while pending:
+        ready = [t for t in pending
+                 if not any(f.rel_model in models_left and f.rel_model is not t.model
+                            for f in t.model._meta.sorted_fields if isinstance(f, ForeignKeyField))]
+        if not ready:
+            raise ValueError('foreign key cycle between {}'.format(', '.join(t.name for t in pending)))
+        for table in ready:
+            pending.remove(table)
+            models_left.discard(table.model)
+            ordered.append(table)
+    return ordered
+
+
+def _select_tables(names=None):
+    """Tables for ``--tables``: short or database names, or ``all``, in foreign key order. TABLES by default."""
+    if not names:
+        return TABLES
+    if 'all' in names:
+        return _dependency_order(ALL_TABLES)
+    known = {}
+    for table in ALL_TABLES:
+        known[table.name] = known[table.model._meta.db_table] = table
+    unknown = [name for name in names if name not in known]
+    if unknown:
+        raise ValueError('unknown tables: {}'.format(', '.join(unknown)))
+    selected = []
+    for name in names:
+        if known[name] not in selected:
+            selected.append(known[name])
+    return _dependency_order(selected)
+
+
+# Sharded layout: the raw value tables of db.sqlite3 also live in db.sqlite3.shards/YYYY-MM.sqlite3, a file per month.
+SHARD_FORMAT = '%Y-%m'
+SHARD_EXTENSION = '.sqlite3'
+SHARDED_TABLES = TABLES
+SHARDED_MODELS = [t.model for t in SHARDED_TABLES]
+# SQLITE_MAX_ATTACHED, which sqlite3.Connection.setlimit() cannot raise.
+SHARD_ATTACH_LIMIT = 10
+
+
+def _shard_dir(path):
+    return (path or DEFAULT_SQLITE_FILE) + SHARD_SUFFIX
+
+
+def _sharded(path):
+    return os.path.isdir(_shard_dir(path))
+
+
+def _month(dt):
+    return datetime.datetime(dt.year, dt.month, 1)
+
+
+def _next_month(dt):
+    return datetime.datetime(dt.year + dt.month // 12, dt.month % 12 + 1, 1)
+
+
+def _shard_file(path, month):
+    return os.path.join(_shard_dir(path), month.strftime(SHARD_FORMAT) + SHARD_EXTENSION)
+
+
+def _shard_months(path, start=None, end=None):
+    """Months of the shards of ``path`` overlapping ``[start, end)``, every shard when None."""
+    months = []
+    for name in sorted(os.listdir(_shard_dir(path))):
+        if not name.endswith(SHARD_EXTENSION):
+            continue
+        month = datetime.datetime.strptime(name[:-len(SHARD_EXTENSION)], SHARD_FORMAT)
+        if (start is None or _next_month(month) > start) and (end is None or month < end):
+            months.append(month)
+    return months
+
+
+class ShardedDatabase(SqliteDatabase):
+    """The main database, with the raw value tables also reading the shards that overlap a window.
+
+    Every connection attaches those shards and shadows each raw value table with a temporary
+    view of the union of the main table and the shard tables, so queries need no change and
+    SQLite pushes their ``time`` bounds down to the index of each shard. Writes to the views
+    fail: rows are written to the main tables and moved to their shards by ``_route_to_shards()``.
+
+    Modes without a window, which may need more shards than SQLite attaches at once, read
+    ``_shard_groups()`` of them one after the other instead.
+    """
+
+    def __init__(self, database, path, window=(None, None), readonly=False, **kwargs):
+        self.path = path
+        self._readonly = readonly
+        self._months = None
+        self._main = True
+        super(ShardedDatabase, self).__init__(database, **kwargs)
+        if window == (None, None):
+            self.set_months([])
+        else:
+            self.set_window(*window)
+
+    def set_window(self, start=None, end=None):
+        """Attach the shards overlapping ``[start, end)`` from the next connection on, reconnecting if they changed."""
+        months = _shard_months(self.path, start, end)
+        if len(months) > SHARD_ATTACH_LIMIT:
+            raise ValueError('{} monthly shards overlap {} to {}, at most {} can be read at once, use a shorter '
+                             'window'.format(len(months), start, end, SHARD_ATTACH_LIMIT))
+        self.set_months(months)
+        self.window = (start, end)
+
+    def set_months(self, months, main=True):
+        """Attach the shards of ``months`` from the next connection on, reconnecting if they changed.
+
+        Args:
+            months: At most ``SHARD_ATTACH_LIMIT`` months.
+            main: Whether the views also read the rows left in the main tables. Only one group of a
+                run should, or those rows are read once per group.
+        """
+        if (months, main) != (self._months, self._main) and self._months is not None and not self.is_closed():
+            self.close()
+        self._months = list(months)
+        self._main = main
+        self.window = None
+
+    def initialize_connection(self, conn):
+        schemas = []
+        for month in self._months:
+            file = _shard_file(self.path, month)
+            if self._readonly:
+                file = _readonly_uri(file)
+            schema = 'shard_' + month.strftime('%Y_%m')
+            conn.execute('ATTACH DATABASE ? AS "{}"'.format(schema), [file])
+            schemas.append(schema)
+        for table in SHARDED_TABLES:
+            name = table.model._meta.db_table
+            conn.execute('CREATE TEMP VIEW "{0}" AS {1}'.format(name, ' UNION ALL '.join(
+                'SELECT * FROM "{}"."{}"'.format(schema, name) for schema in ['main'] * self._main + schemas)))
+
+
+def _open_database(path=None, readonly=False, window=None):
+    """Open the sqlite database, read-only when asked, and bind the models to it.
+
+    Args:
+        window: ``(start, end)`` of the raw values to read from the shards of a sharded layout.
+            ``(None, None)`` attaches none at first, for commands that read the shards they need
+            ``_shard_groups()`` at a time. None reads the main database only.
+    """
+    path = path or DEFAULT_SQLITE_FILE
+    name, kwargs = path, {}
+    if readonly:
+        name, kwargs = _readonly_uri(path), {'uri': True}
+    if window is not None and _sharded(path):
+        database = ShardedDatabase(name, path, window, readonly, **kwargs)
+    else:
+        database = SqliteDatabase(name, **kwargs)
+    database_proxy.initialize(database)
+    return database
+
+
+def _shard_groups(months, size=SHARD_ATTACH_LIMIT):
+    """Split ``months`` into ``(months, main)`` groups for ``ShardedDatabase.set_months()``.
+
+    Each group has at most ``size`` shards, and only the first also reads the main tables.
+    """
+    return [(months[i:i + size], i == 0) for i in range(0, len(months), size)] or [([], True)]
+
+
+def _window_pieces(start, end):
+    """Split ``[start, end)`` into consecutive pieces whose shards can all be attached at once.
+
+    Read each piece after ``_set_window()``. A database without shards reads the window in one piece.
+    """
+    if not isinstance(database_proxy.obj, ShardedDatabase):
+        return [(start, end)]
+    return [(pieces[0][0], pieces[-1][1]) for _, pieces in _window_groups([(start, end)])]
+
+
+def _set_window(start, end):
+    """Attach the shards overlapping ``[start, end)`` when the database is sharded."""
+    if isinstance(database_proxy.obj, ShardedDatabase):
+        database_proxy.obj.set_window(start, end)
+
+
+def _changed_shards(path, model, updated=None):
+    """Months of the shards holding rows of ``model`` updated at or after ``updated``, and the last update.
+
+    Each shard is asked on a connection of its own, through the ``updated`` index, so any number of them can be.
+
+    Args:
+        path: Path of the main database.
+        model: A model of ``SHARDED_TABLES``.
+        updated: Text of an ``updated`` value, or None for the shards holding any row.
+
+    Returns:
+        The months, and the greatest ``updated`` text of the main table and the shards, None when all are empty.
+    """
+    name = model._meta.db_table
+    where, params = ('WHERE "updated" >= ?', [updated]) if updated is not None else ('', [])
+    last = database_proxy.execute_sql('SELECT MAX("updated") FROM main."{}"'.format(name)).fetchone()[0]
+    months = []
+    for month in _shard_months(path):
+        conn = sqlite3.connect(_readonly_uri(_shard_file(path, month)), uri=True)
+        try:
+            if conn.execute('SELECT 1 FROM "{}" {} LIMIT 1'.format(name, where), params).fetchone() is None:
+                continue
+            months.append(month)
+            shard_last = conn.execute('SELECT MAX("updated") FROM "{}"'.format(name)).fetchone()[0]
+        finally:
+            conn.close()
+        last = shard_last if last is None else max(last, shard_last)
+    return months, last
+
+
+def _count_shards(path, model):
+    """Rows of ``model`` in the main table and every shard."""
+    name = model._meta.db_table
+    total = database_proxy.execute_sql('SELECT COUNT(*) FROM main."{}"'.format(name)).fetchone()[0]
+    for month in _shard_months(path):
+        conn = sqlite3.connect(_readonly_uri(_shard_file(path, month)), uri=True)
+        try:
+            total += conn.execute('SELECT COUNT(*) FROM "{}"'.format(name)).fetchone()[0]
+        finally:
+            conn.close()
+    return total
+
+
+def _create_shard(path, file):
+    """Create a shard with the raw value tables and indexes of the main database, without its triggers."""
+    ddl = [row[0] for row in database_proxy.execute_sql(
+        'SELECT "sql" FROM main.sqlite_master WHERE "tbl_name" IN ({}) AND "sql" IS NOT NULL '
+        'AND "type" != \'trigger\' ORDER BY "type" DESC'.format(', '.join('?' * len(SHARDED_TABLES))),
+        [t.model._meta.db_table for t in SHARDED_TABLES])]
+    tmp = file + '.tmp'
+    conn = sqlite3.connect(tmp)
+    try:
+        conn.executescript(';\n'.join(ddl))
+    finally:
+        conn.close()
+    os.replace(tmp, file)
+    log.info('created shard {}'.format(file))
+
+
+def _route_to_shards(path=None, on_conflict=None):
+    """Move the raw values written to the main database into their monthly shards, a month per transaction.
+
+    Without ``on_conflict``, rows whose id is already in their shard are deleted from the main
+    database, as the failed insert of a single database would have left them out, and a ValueError
+    is raised. Rows stay in the main database, where queries still see them, when a move fails otherwise.
+
+    Args:
+        path: Path of the main database.
+        on_conflict: None to fail on ids already in a shard, or one of ``ON_CONFLICT``.
+
+    Returns:
+        Number of rows moved.
+    """
+    path = path or DEFAULT_SQLITE_FILE
+    moved = 0
+    for table in SHARDED_TABLES:
+        model = table.model
+        name = model._meta.db_table
+        columns = ', '.join('"{}"'.format(f.db_column) for f in model._meta.sorted_fields)
+        verb = {'ignore': 'INSERT OR IGNORE', 'replace': 'INSERT OR REPLACE'}.get(on_conflict, 'INSERT')
+        insert = '{0} INTO "shard"."{1}" ({2}) SELECT {2} FROM main."{1}" WHERE "time" >= ? AND "time" < ?'.format(
+            verb, name, columns)
+        if on_conflict == 'update-if-newer':
+            insert += _upsert_clause(model)
+        first = 'SELECT MIN("time") FROM main."{}" WHERE "time" >= ?'.format(name)
+        bound = ''
+        while True:
+            time_string = database_proxy.execute_sql(first, [bound]).fetchone()[0]
+            if time_string is None:
+                break
+            start = _parse_datetime(time_string)
+            if start is None:
+                raise ValueError('{}: cannot route the row with time {!r} to a shard'.format(name, time_string))
+            start = _month(start)
+            end = _next_month(start)
+            file = _shard_file(path, start)
+            if not os.path.exists(file):
+                _create_shard(path, file)
+            database_proxy.execute_sql('ATTACH DATABASE ? AS "shard"', [file])
+            try:
+                started = time.perf_counter()
+                params = [str(start), str(end)]
+                if on_conflict is None:
+                    with database_proxy.atomic():
+                        duplicates = database_proxy.execute_sql(
+                            'DELETE FROM main."{0}" WHERE "time" >= ? AND "time" < ? AND "{1}" IN '
+                            '(SELECT "{1}" FROM "shard"."{0}")'.format(name, model._meta.primary_key.db_column),
+                            params).rowcount
+                        _add_rows(model, -duplicates)
+                    if duplicates:
+                        raise ValueError('{}: {} rows have ids already in {}, they were left out. Import them with '
+                                         '--on-conflict'.format(table.name, duplicates, file))
+                with database_proxy.atomic():
+                    written = database_proxy.execute_sql(insert, params).rowcount
+                    staged = database_proxy.execute_sql(
+                        'DELETE FROM main."{}" WHERE "time" >= ? AND "time" < ?'.format(name), params).rowcount
+                    if on_conflict == 'ignore':
+                        _add_rows(model, written - staged)
+                METRICS.add(name, 'route', time.perf_counter() - started, staged)
+            finally:
+                database_proxy.execute_sql('DETACH DATABASE "shard"')
+            log.info('{}: {} rows moved to {}'.format(table.name, staged, file))
+            moved += staged
+            bound = str(end)
+    return moved
+
+
+def _shard(path=None, on_conflict=None):
+    """Switch ``path`` to the sharded layout, or finish moving rows left in its main tables, and route them."""
+    path = path or DEFAULT_SQLITE_FILE
+    _makedirs(_shard_dir(path))
+    for table in SHARDED_TABLES:
+        # The kept counts cover every shard, they cannot be recounted from the main tables once rows moved.
+        _add_rows(table.model, 0)
+    moved = _route_to_shards(path, on_conflict)
+    if moved:
+        log.info('{} rows moved, VACUUM {} to give their space back'.format(moved, path))
+    return moved
+
+
+def _measured(fn, *args):
+    """Run ``fn`` in a pool process and return its result and metrics."""
+    METRICS.reset()
+    result = fn(*args)
+    return result, METRICS.snapshot()
+
+
+def _run_parallel(jobs, sqlite, readonly, fn, tasks, window=None):
+    """Run ``fn(*task)`` for every task in a pool of ``jobs`` processes, each with its own connection.
+
+    Args:
+        window: Window of the shards to read, see ``_open_database()``.
+
+    Returns:
+        The results, in the order of ``tasks``.
+    """
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_open_database,
+                                                initargs=(sqlite, readonly, window)) as executor:
+        futures = [executor.submit(_measured, fn, *task) for task in tasks]
+        for future in futures:
+            result, snapshot = future.result()
+            METRICS.merge(snapshot)
+            results.append(result)
+    return results
+
+
+def _export_table(table, directory, date, hour=None, fmt='csv'):
+    file = _table_file(directory, table.name, fmt)
+    count = _export_csv(file, table.model, table.fieldnames, date, hour=hour, fmt=fmt)
+    return [{'table': table.name, 'file': file, 'rows': count}]
+
+
+def _export(directory, date, hour=None, jobs=1, sqlite=None, fmt='csv', stats=None, tables=None):
+    """Export ``tables`` to ``directory``, ``jobs`` tables at a time, and write its manifest.
+
+    Tables without a time column are exported whole.
+    """
+    tables = tables or TABLES
+    _makedirs(directory)
+    if jobs > 1:
+        results = _run_parallel(jobs, sqlite, True, _export_table, [(t, directory, date, hour, fmt) for t in tables],
+                                _time_range(date, hour))
+    else:
+        results = [_export_table(table, directory, date, hour, fmt) for table in tables]
+    _write_manifest(directory, list(itertools.chain.from_iterable(results)), stats, tables)
+
+
+def _open_partition(table, directory, layout, bound, fmt='csv'):
+    folder = os.path.join(directory, bound.strftime(layout))
+    _makedirs(folder)
+    return _open_writer(_table_file(folder, table.name, fmt), table.model, table.fieldnames, fmt)
+
+
+def _export_partitioned(table, directory, start, end, partition='day', fmt='csv'):
+    """Export ``[start, end)`` of one table in a single ordered pass, split into partition folders.
+
+    Every partition in the window gets a file, with only the header when it has no rows,
+    so each folder can be imported on its own.
+
+    Returns:
+        Manifest entries of the partition files.
+    """
+    step, layout = PARTITIONS[partition]
+    model = table.model
+    field = _time_field(model)
+    log.info('start export from {0}. filter {1} to {2} by {3}'.format(model.__name__, start, end, partition))
+    query = (model.select()
+             .where((field >= start) & (field < end))
+             .order_by(field)
+             .dicts())
+
+    name = model._meta.db_table
+    files = []
+
+    def close():
+        writer.close()
+        log.info('{} exported to {}'.format(count, writer.name))
+        files.append({'table': table.name, 'file': writer.name, 'rows': count,
+                      'start': str(bound - step), 'end': str(min(bound, end))})
+
+    writer = _open_partition(table, directory, layout, start, fmt)
+    write = METRICS.timed_call(lambda record: writer.writerow(record), name, 'write')
+    bound = start + step
+    count = total = 0
+    try:
+        with METRICS.timer(name, 'query'):
+            records = query.execute()
+        for record in METRICS.timed(records, name, 'fetch'):
+            while record[field.name] >= bound:
+                close()
+                writer = _open_partition(table, directory, layout, bound, fmt)
+                bound += step
+                count = 0
+            count += 1
+            total += 1
+            write(record)
+        while bound < end:
+            close()
+            writer = _open_partition(table, directory, layout, bound, fmt)
+            bound += step
+            count = 0
+    except BaseException:
+        writer.close()
+        raise
+    close()
+    log.info('Total {} from {} to {}'.format(total, start, end))
+    return files
+
+
+def _export_range(directory, start, end, partition='day', jobs=1, sqlite=None, fmt='csv', stats=None, tables=None):
+    """Export the days ``[start, end)`` of ``tables`` into ``directory/YYYY-MM-DD[/HH]/``.
+
+    With ``jobs`` > 1 each table and day is a separate task in the process pool.
+    Tables without a time column are exported whole into ``directory`` itself.
+    The manifest of all the partitions is written to ``directory``.
+    """
+    selected = tables or TABLES
+    _makedirs(directory)
+    whole = [_export_table(t, directory, None, fmt=fmt) for t in selected if _time_field(t.model) is None]
+    tables = [t for t in selected if _time_field(t.model) is not None]
+    # A sharded database is read a window of shards at a time, the partitions of a piece in one pass.
+    results = {t.name: [] for t in tables}
+    for first, last in _window_pieces(start, end):
+        if jobs > 1:
+            days = []
+            day = first
+            while day < last:
+                days.append(day)
+                day += datetime.timedelta(days=1)
+            tasks = [(t, directory, d, min(d + datetime.timedelta(days=1), last), partition, fmt)
+                     for t in tables for d in days]
+            for task, files in zip(tasks, _run_parallel(jobs, sqlite, True, _export_partitioned, tasks,
+                                                        (first, last))):
+                results[task[0].name].append(files)
+        else:
+            _set_window(first, last)
+            for table in tables:
+                results[table.name].append(_export_partitioned(table, directory, first, last, partition, fmt))
+    results = [files for t in tables for files in results[t.name]]
+    _write_manifest(directory, list(itertools.chain.from_iterable(whole + results)), stats, selected)
+
+
+def _export_changes(file, table, watermark=None, fmt='csv'):
+    """Export the rows of ``table`` changed after ``watermark``, ordered by ``(updated, id)``.
+
+    Creation, edits and soft deletes all bump ``updated``, so this picks up every change. In a sharded
+    layout, only the shards holding changes are read, and when there are more of them than SQLite
+    attaches at once, the rows are in that order within each group of shards.
+
+    Args:
+        file: Csv file to write.
+        table: Table to export.
+        watermark: ``{'updated': ..., 'id': ...}`` of the last row exported before, or None.
+        fmt: One of ``FORMATS``.
+
+    Returns:
+        The watermark of the last row written, or ``watermark`` when nothing changed, and the rows written.
+    """
+    model = table.model
+    query = model.select()
+    if watermark:
+        updated = _parse_datetime(watermark['updated'])
+        query = query.where((model.updated >= updated) &
+                            ((model.updated > updated) | (model.id > watermark['id'])))
+    database = database_proxy.obj
+    groups = [None]
+    if isinstance(database, ShardedDatabase) and model in SHARDED_MODELS:
+        months, until = _changed_shards(database.path, model, watermark and watermark['updated'])
+        groups = _shard_groups(months)
+        if len(groups) > 1:
+            # Each group is in (updated, id) order on its own. Reading all of them up to the same update
+            # leaves the rows updated meanwhile to the next run, past the watermark of this one.
+            query = query.where(model.updated <= until)
+    query = query.order_by(model.updated, model.id).dicts()
+    log.info('start export from {0}. changes after {1}'.format(model.__name__, watermark))
+
+    name = model._meta.db_table
+    last = None
+    with _open_writer(file, model, table.fieldnames, fmt) as writer:
+        write = METRICS.timed_call(writer.writerow, name, 'write')
+        count = 0
+        for group in groups:
+            if group is not None:
+                database.set_months(*group)
+            with METRICS.timer(name, 'query'):
+                records = query.clone().execute()
+            record = None
+            for record in METRICS.timed(records, name, 'fetch'):
+                count += 1
+                write(record)
+            if record is not None and (last is None or (record['updated'], record['id']) > (last['updated'], last['id'])):
+                last = record
+    log.info('{} changes exported to {}'.format(count, file))
+    if last is None:
+        return watermark, count
+    return {'updated': str(last['updated']), 'id': last['id']}, count
+
+
+def _check_incremental(tables):
+    """Incremental exports follow ``(updated, id)``, which not every model has."""
+    missing = [t.name for t in tables if not {'updated', 'id'} <= set(t.model._meta.fields)]
+    if missing:
+        raise ValueError('cannot export incrementally without updated and id columns: {}'.format(', '.join(missing)))
+
+
+def _export_incremental(directory, state_file, fmt='csv', stats=None, tables=None):
+    """Export what changed since the last run into a new ``directory/<run time>/`` folder.
+
+    The watermarks in ``state_file`` only move once every table has been written.
+    A run without any change leaves no folder behind.
+
+    Returns:
+        The folder written, or None.
+    """
+    tables = tables or TABLES
+    _check_incremental(tables)
+    state = _load_state(state_file)
+    folder = os.path.join(directory, datetime.datetime.now().strftime('%Y%m%dT%H%M%S.%f'))
+    os.makedirs(folder)
+    changed = {}
+    files = []
+    for table in tables:
+        file = _table_file(folder, table.name, fmt)
+        watermark, count = _export_changes(file, table, state.get(table.name), fmt)
+        files.append({'table': table.name, 'file': file, 'rows': count})
+        if watermark != state.get(table.name):
+            changed[table.name] = watermark
+    if not changed:
+        shutil.rmtree(folder)
+        log.info('no changes')
+        return None
+    _write_manifest(folder, files, stats, tables)
+    state.update(changed)
+    _save_state(state_file, state)
+    return folder
+
+
+ROW_COUNTS = 'tool_row_count'
+
+
+def _has_table(name):
+    return database_proxy.execute_sql(
+        'SELECT 1 FROM sqlite_master WHERE type = \'table\' AND name = ?', [name]).fetchone() is not None
+
+
+def _add_rows(model, delta):
+    """Keep the cached row count of ``model`` in step with the rows this tool inserts or deletes.
+
+    Call it in the transaction of the write. The first call counts the table once.
+
+    Args:
+        model: Model written to.
+        delta: Rows added, negative for deleted. None drops the count, for writes that cannot tell.
+    """
+    table = model._meta.db_table
+    database_proxy.execute_sql('CREATE TABLE IF NOT EXISTS "{}" ("table" TEXT PRIMARY KEY, '
+                               '"rows" INTEGER NOT NULL, "updated" TEXT NOT NULL)'.format(ROW_COUNTS))
+    if delta is None:
+        database_proxy.execute_sql('DELETE FROM "{}" WHERE "table" = ?'.format(ROW_COUNTS), [table])
+        return
+    now = str(datetime.datetime.now())
+    cursor = database_proxy.execute_sql(
+        'UPDATE "{}" SET "rows" = "rows" + ?, "updated" = ? WHERE "table" = ?'.format(ROW_COUNTS), [delta, now, table])
+    if not cursor.rowcount:
+        database_proxy.execute_sql('INSERT INTO "{}" ("table", "rows", "updated") SELECT ?, COUNT(*), ? FROM "{}"'.format(
+            ROW_COUNTS, table), [table, now])
+
+
+def _table_total(model, stats):
+    """Total rows of ``model``, and where the number comes from.
+
+    ``exact`` counts the table. ``cached`` reads the count kept by ``_add_rows()``, which misses writes of
+    other programs. ``estimate`` reads the row estimate of the last ANALYZE from sqlite_stat1. ``cached``
+    falls back to ``estimate``, and that to None.
+    """
+    table = model._meta.db_table
+    if stats == 'exact':
+        database = database_proxy.obj
+        if isinstance(database, ShardedDatabase) and model in SHARDED_MODELS:
+            return _count_shards(database.path, model), 'exact'
+        return model.select().count(), 'exact'
+    if stats == 'cached' and _has_table(ROW_COUNTS):
+        row = database_proxy.execute_sql(
+            'SELECT "rows", "updated" FROM "{}" WHERE "table" = ?'.format(ROW_COUNTS), [table]).fetchone()
+        if row is not None:
+            return row[0], 'cached {}'.format(row[1])
+    if _has_table('sqlite_stat1'):
+        estimates = [int(stat.split()[0]) for stat, in database_proxy.execute_sql(
+            'SELECT "stat" FROM sqlite_stat1 WHERE "tbl" = ?', [table])]
+        if estimates:
+            return max(estimates), 'estimate'
+    return None, None
+
+
+def _write_manifest(directory, files, stats=None, tables=None):
+    """Write the exported files, their rows, sizes and sha256 to ``directory/manifest.json``.
+
+    Args:
+        directory: Export directory. File paths are made relative to it.
+        files: Dicts of ``table``, ``file`` and ``rows``, and ``start``/``end`` for partitions.
+        stats: None, or one of ``STATS`` to add the total rows of each table.
+        tables: Tables exported, TABLES by default.
+    """
+    totals = {}
+    for table in tables or TABLES:
+        info = {'exported': sum(f['rows'] for f in files if f['table'] == table.name)}
+        if stats is not None:
+            info['total'], info['total_source'] = _table_total(table.model, stats)
+            log.info('{}: {} exported, {} in the table ({})'.format(
+                table.name, info['exported'], info['total'], info['total_source']))
+        totals[table.name] = info
+    _save_manifest(directory, files, totals)
+
+
+def _load_manifest(folder):
+    """Manifest entries by path of the files in ``folder``, empty without a manifest.
+
+    The manifest of a range export sits above its partition folders, so the parents are searched too.
+    """
+    directory = os.path.abspath(folder)
+    while True:
+        manifest = _load_state(os.path.join(directory, MANIFEST))
+        if manifest:
+            return {os.path.join(directory, os.path.normpath(f['file'])): f for f in manifest.get('files', [])}
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return {}
+        directory = parent
+
+
+# WAL with synchronous=NORMAL skips the fsync of every commit but cannot corrupt the database on a crash.
+FAST_LOAD_PRAGMAS = [
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('cache_size', -262144),  # 256 MiB
+    ('temp_store', 'memory'),
+    ('mmap_size', 1 << 30),
+]
+
+
+def _pragma(name, value=None):
+    if value is None:
+        return database_proxy.execute_sql('PRAGMA {}'.format(name)).fetchone()[0]
+    return database_proxy.execute_sql('PRAGMA {} = {}'.format(name, value)).fetchone()
+
+
+@contextlib.contextmanager
+def _fast_load(models, drop_indexes=False):
+    """Tune the connection for a bulk load into ``models``, then restore its settings and ANALYZE them.
+
+    Args:
+        models: Models about to be loaded.
+        drop_indexes: Drop their non-unique indexes during the load and rebuild them afterwards.
+    """
+    saved = [(name, _pragma(name)) for name, _ in FAST_LOAD_PRAGMAS]
+    for name, value in FAST_LOAD_PRAGMAS:
+        _pragma(name, value)
+    dropped = []
+    if drop_indexes:
+        for model in models:
+            for index in database_proxy.get_indexes(model._meta.db_table):
+                # Unique indexes enforce ids and ON CONFLICT targets, automatic ones have no sql.
+                if index.sql and not index.unique:
+                    log.info('dropping index {}'.format(index.name))
+                    database_proxy.execute_sql('DROP INDEX "{}"'.format(index.name))
+                    dropped.append(index)
+    try:
+        yield
+    finally:
+        for index in dropped:
+            log.info('rebuilding index {}'.format(index.name))
+            database_proxy.execute_sql(index.sql)
+        for name, value in saved:
+            _pragma(name, value)
+        if _pragma('journal_mode') != saved[0][1]:
+            log.warning('journal_mode left as {}, the database is in use'.format(_pragma('journal_mode')))
+        # Sampled statistics are enough for the planner and keep ANALYZE cheap on big tables (SQLite 3.32+).
+        _pragma('analysis_limit', 1000)
+        for model in models:
+            database_proxy.execute_sql('ANALYZE "{}"'.format(model._meta.db_table))
+
+
+def _chunks(iterable, size):
+    """Yield lists of at most ``size`` items from ``iterable``."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _fromisoformat(date_string):
+    # Fallback for interpreters without datetime.fromisoformat (< 3.7).
+    fmt = '%Y-%m-%d %H:%M:%S.%f' if '.' in date_string else '%Y-%m-%d %H:%M:%S'
+    return datetime.datetime.strptime(date_string, fmt)
+
+
+_fromisoformat = getattr(datetime.datetime, 'fromisoformat', _fromisoformat)
+
+
+def _parse_datetime(date_string):
+    """Parse a stored timestamp, with or without microseconds. Invalid values become None."""
+    if not date_string:
+        return None
+    try:
+        return _fromisoformat(date_string)
+    except ValueError:
+        return None
+
+
+def _parse_bool(b_string):
+    return b_string == 'True'
+
+
+def _nullable(t):
+    def parse(s):
+        return t(s) if s else None
+    return parse
+
+
+PARSERS = {
+    datetime.datetime: _parse_datetime,
+    bool: _parse_bool,
+}
+
+
+def _row_converter(fieldnames, typed_fileds=None, as_tuple=False):
+    """Compile a function turning one csv record (a list of strings) into an insertable dict.
+
+    The parser of every column is looked up once here rather than per row.
+
+    Args:
+        fieldnames: Header of the csv file.
+        typed_fileds: Optional mapping of type to field names, such as ``{int: {'x', 'y'}}``.
+        as_tuple: Return a tuple of the values in ``fieldnames`` order instead of a dict.
+
+    Returns:
+        A function of a list of strings returning a dict, or a tuple.
+    """
+    parsers = dict.fromkeys(fieldnames, str)
+    for t, fields in (typed_fileds or {}).items():
+        for key in fields:
+            if key in parsers:
+                parsers[key] = PARSERS.get(t) or _nullable(t)
+    keys = tuple(fieldnames)
+    column_parsers = tuple(parsers[key] for key in keys)
+
+    if as_tuple:
+        def convert(values):
+            return tuple([parse(v) for parse, v in zip(column_parsers, values)])
+        return convert
+
+    def convert(values):
+        return dict(zip(keys, [parse(v) for parse, v in zip(column_parsers, values)]))
+    return convert
+
+
+@functools.lru_cache(maxsize=None)
+def _model_converter(model, fieldnames, as_tuple=False):
+    """``_row_converter()`` of a csv header of ``model``, typed from its fields and compiled once per header."""
+    return _row_converter(fieldnames, _typed_fields(model), as_tuple)
+
+
+def _read_csv(file, model, fmt='csv'):
+    """Lazily read and convert the rows of an exported csv file of ``model``."""
+    with _open_text(file, 'r', fmt) as f:
+        reader = csv.reader(f)
+        fieldnames = next(reader, None)
+        if fieldnames is None:
+            return
+        convert = _model_converter(model, tuple(fieldnames))
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        count = 0
+        for values in reader:
+            count += 1
+            row = convert(values)
+            if debug and count % 1000 == 1:
+                log.debug('{}: {}'.format(count, row.get('id')))
+            yield row
+
+
+@functools.lru_cache(maxsize=None)
+def _upsert_clause(model):
+    """``ON CONFLICT`` clause updating an existing row only when the incoming one has a newer ``updated``."""
+    pk = model._meta.primary_key.db_column
+    columns = [f.db_column for f in model._meta.sorted_fields if f.db_column != pk]
+    return ' ON CONFLICT ("{0}") DO UPDATE SET {1} WHERE excluded."updated" > "{2}"."updated"'.format(
+        pk, ', '.join('"{0}" = excluded."{0}"'.format(c) for c in columns), model._meta.db_table)
+
+
+@functools.lru_cache(maxsize=None)
+def _insert_statement(model, keys, on_conflict=None):
+    """Single-row INSERT for the fields ``keys`` of ``model``.
+
+    Prepared once and run with executemany(), this spares the per-row SQL generation of
+    ``insert_many``, and a batch can hold any number of rows.
+    """
+    fields = [model._meta.fields[key] for key in keys]
+    verb = {'ignore': 'INSERT OR IGNORE', 'replace': 'INSERT OR REPLACE'}.get(on_conflict, 'INSERT')
+    sql = '{0} INTO "{1}" ({2}) VALUES ({3})'.format(
+        verb, model._meta.db_table, ', '.join('"{}"'.format(f.db_column) for f in fields), ', '.join('?' * len(fields)))
+    if on_conflict == 'update-if-newer':
+        sql += _upsert_clause(model)
+    return sql
+
+
+def _single_value(key, row):
+    return row[key],
+
+
+def _insert_rows(model, rows, on_conflict=None):
+    """Insert one batch, resolving primary key conflicts as asked.
+
+    Args:
+        model: Model to insert into.
+        rows: List of dicts with the same keys, holding values already converted by a reader.
+        on_conflict: None to fail on conflicts, or one of ``ON_CONFLICT``.
+
+    Returns:
+        Number of rows inserted or updated.
+    """
+    if not rows:
+        return 0
+    keys = tuple(rows[0])
+    values = operator.itemgetter(*keys)
+    if len(keys) == 1:
+        values = functools.partial(_single_value, keys[0])
+    return _insert_values(model, keys, map(values, rows), on_conflict)
+
+
+def _insert_values(model, keys, rows, on_conflict=None):
+    """Insert one batch of value tuples, in the order of the fields ``keys``."""
+    cursor = database_proxy.get_cursor()
+    cursor.executemany(_insert_statement(model, keys, on_conflict), rows)
+    return cursor.rowcount
+
+
+def _inserted(written, on_conflict=None):
+    """Rows added by an insert that wrote ``written`` rows, None when updates are counted in too."""
+    return written if on_conflict in (None, 'ignore') else None
+
+
+def _read_rows(file, model, fmt='csv'):
+    if fmt in COLUMNAR_FORMATS:
+        return _read_columnar(file, model, fmt)
+    return _read_csv(file, model, fmt)
+
+
+def _import_csv(file, model, bulk_number=100, on_conflict=None, fmt='csv'):
+    """Stream an exported file into ``model``, holding at most one batch in memory."""
+    log.info('reading {}'.format(file))
+    name = model._meta.db_table
+    count = written = 0
+    with database_proxy.atomic():
+        for rows in _chunks(METRICS.timed(_read_rows(file, model, fmt), name, 'convert'), bulk_number):
+            with METRICS.timer(name, 'insert', len(rows)):
+                written += _insert_rows(model, rows, on_conflict)
+            count += len(rows)
+        _add_rows(model, _inserted(written, on_conflict))
+        committing = time.perf_counter()
+    METRICS.add(name, 'commit', time.perf_counter() - committing)
+
+    log.info('{} done, {} written'.format(count, written))
+
+
+def _parse_worker(queue, table, file, batch_size, fmt='csv'):
+    """Parse ``file`` in a child process, sending converted batches to the writer through ``queue``."""
+    METRICS.reset()
+    name = table.model._meta.db_table
+    try:
+        for rows in _chunks(METRICS.timed(_read_rows(file, table.model, fmt), name, 'convert'), batch_size):
+            queue.put((table.name, rows))
+    except Exception as e:
+        queue.put((table.name, e))
+    else:
+        queue.put((table.name, {'metrics': METRICS.snapshot()}))
+
+
+def _import_parallel(folder, bulk_number=100, jobs=2, on_conflict=None, fmt='csv', tables=None):
+    """Parse the csv files in up to ``jobs`` processes and insert them through this single connection.
+
+    SQLite has one writer, so the batches of all tables are written in one transaction
+    in the order they arrive. ``queue`` is bounded to keep memory flat when parsing
+    outruns inserting.
+    """
+    import multiprocessing
+    tables = tables or TABLES
+    models = {table.name: table.model for table in tables}
+    queue = multiprocessing.Queue(maxsize=jobs * 4)
+    pending = [(t, _table_file(folder, t.name, fmt)) for t in tables]
+    workers = []
+    counts = collections.Counter()
+    written = collections.Counter()
+    with database_proxy.atomic():
+        try:
+            while pending or workers:
+                while pending and len(workers) < jobs:
+                    table, file = pending.pop(0)
+                    log.info('reading {}'.format(file))
+                    worker = multiprocessing.Process(target=_parse_worker,
+                                                     args=(queue, table, file, bulk_number, fmt))
+                    worker.start()
+                    workers.append((table.name, worker))
+                try:
+                    name, rows = queue.get(timeout=1)
+                except Empty:
+                    for name, worker in workers:
+                        if worker.exitcode not in (None, 0):
+                            raise RuntimeError('parsing {} failed with exit code {}'.format(name, worker.exitcode))
+                    continue
+                if isinstance(rows, Exception):
+                    raise rows
+                if isinstance(rows, dict):
+                    # End of the file, with the metrics of the worker.
+                    METRICS.merge(rows['metrics'])
+                    for item in [w for w in workers if w[0] == name]:
+                        item[1].join()
+                        workers.remove(item)
+                    log.info('{} {} done, {} written'.format(name, counts[name], written[name]))
+                    continue
+                with METRICS.timer(models[name]._meta.db_table, 'insert', len(rows)):
+                    written[name] += _insert_rows(models[name], rows, on_conflict)
+                counts[name] += len(rows)
+            for name in written:
+                _add_rows(models[name], _inserted(written[name], on_conflict))
+            committing = time.perf_counter()
+        finally:
+            for _, worker in workers:
+                worker.terminate()
+    # The tables share one transaction.
+    METRICS.add('all', 'commit', time.perf_counter() - committing)
+
+
+RANGE_SIZE = 8 << 20
+
+
+def _csv_ranges(file, size=RANGE_SIZE):
+    """Header of a plain csv file and the newline aligned ``(start, end)`` byte ranges of its rows.
+
+    Ranges are about ``size`` bytes. Splitting on newlines assumes no value holds one, which
+    ``_parse_range()`` checks by counting the values of every row.
+    """
+    with open(file, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return None, []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            start = m.find(b'\n') + 1 or len(m)
+            header = next(csv.reader([m[:start].decode('utf-8')]), None)
+            ranges = []
+            while start < len(m):
+                end = m.find(b'\n', start + size - 1)
+                end = len(m) if end < 0 else end + 1
+                ranges.append((start, end))
+                start = end
+    return header, ranges
+
+
+def _parse_range(file, model, fieldnames, start, end):
+    """Convert the rows in bytes ``[start, end)`` of a plain csv file to value tuples, in a pool process."""
+    started = time.perf_counter()
+    with open(file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        text = m[start:end].decode('utf-8')
+    convert = _model_converter(model, fieldnames, True)
+    width = len(fieldnames)
+    rows = []
+    for values in csv.reader(io.StringIO(text, newline='')):
+        if len(values) != width:
+            raise ValueError('{}: a row in bytes {} to {} has {} values instead of {}, values holding newlines '
+                             'cannot be split, import it with --jobs 1'.format(file, start, end, len(values), width))
+        rows.append(convert(values))
+    METRICS.add(model._meta.db_table, 'convert', time.perf_counter() - started, len(rows))
+    return rows
+
+
+def _import_ranges(folder, bulk_number=100, jobs=2, on_conflict=None, tables=None):
+    """Parse plain csv files a byte range at a time in ``jobs`` processes, and insert the ranges in file order.
+
+    Every table can use all the processes, so one large file no longer parses on a single core.
+    The tables share one transaction, and at most ``jobs * 2`` parsed ranges wait for the writer.
+    """
+    tables = tables or TABLES
+    tasks = []
+    for table in tables:
+        file = _table_file(folder, table.name, 'csv')
+        header, ranges = _csv_ranges(file)
+        log.info('reading {} in {} ranges'.format(file, len(ranges)))
+        tasks.extend((table, file, tuple(header), start, end) for start, end in ranges)
+    tasks = iter(tasks)
+    pending = collections.deque()
+    counts = collections.Counter()
+    written = collections.Counter()
+
+    def submit(n):
+        for table, file, header, start, end in itertools.islice(tasks, n):
+            future = executor.submit(_measured, _parse_range, file, table.model, header, start, end)
+            pending.append((table, header, future))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        with database_proxy.atomic():
+            submit(jobs * 2)
+            while pending:
+                table, header, future = pending.popleft()
+                rows, snapshot = future.result()
+                METRICS.merge(snapshot)
+                submit(1)
+                name = table.model._meta.db_table
+                for batch in _chunks(rows, bulk_number):
+                    with METRICS.timer(name, 'insert', len(batch)):
+                        written[table.name] += _insert_values(table.model, header, batch, on_conflict)
+                counts[table.name] += len(rows)
+            for table in tables:
+                _add_rows(table.model, _inserted(written[table.name], on_conflict))
+                log.info('{} {} done, {} written'.format(table.name, counts[table.name], written[table.name]))
+            committing = time.perf_counter()
+    # The tables share one transaction.
+    METRICS.add('all', 'commit', time.perf_counter() - committing)
+
+
+PROGRESS = 'tool_import_progress'
+
+
+def _read_resumable(file, model, fmt='csv', done=0, offset=None, position=None):
+    """Read the rows of an exported file from where an interrupted import stopped.
+
+    Plain csv files are read from byte ``offset``, other formats skip the ``done`` rows already imported.
+
+    Args:
+        position: List kept at ``[rows, byte offset]`` after the last row yielded.
+    """
+    if fmt != 'csv':
+        position[:] = [done, None]
+        for row in itertools.islice(_read_rows(file, model, fmt), done, None):
+            position[0] += 1
+            yield row
+        return
+    with open(file, 'rb') as f:
+        fieldnames = next(csv.reader([f.readline().decode('utf-8')]), None)
+        if not fieldnames:
+            return
+        convert = _model_converter(model, tuple(fieldnames))
+        if offset:
+            f.seek(offset)
+        position[:] = [done, f.tell()]
+
+        def lines():
+            # csv.reader pulls one line at a time, so the offset stays at the end of the row it yields.
+            for line in f:
+                position[1] += len(line)
+                yield line.decode('utf-8')
+        for values in csv.reader(lines()):
+            position[0] += 1
+            yield convert(values)
+
+
+def _import_checkpointed(file, table, bulk_number=100, checkpoint=100000, on_conflict=None, fmt='csv',
+                         manifest=None):
+    """Import a file committing every ``checkpoint`` rows, with the position in the ``tool_import_progress`` table.
+
+    Files are known by their sha256. A file already imported is skipped, and one that was interrupted
+    is resumed after its last committed chunk.
+
+    Args:
+        manifest: Manifest entry of the file, to verify its checksum and rows against.
+    """
+    model = table.model
+    name = model._meta.db_table
+    checksum = _checksum(file)
+    if manifest and manifest.get('sha256') not in (None, checksum):
+        raise ValueError('{} does not match the checksum in its manifest'.format(file))
+    database_proxy.execute_sql('CREATE TABLE IF NOT EXISTS "{}" ("checksum" TEXT PRIMARY KEY, "file" TEXT NOT NULL, '
+                               '"table" TEXT NOT NULL, "rows" INTEGER NOT NULL, "offset" INTEGER, '
+                               '"done" INTEGER NOT NULL, "updated" TEXT NOT NULL)'.format(PROGRESS))
+    progress = database_proxy.execute_sql('SELECT "rows", "offset", "done" FROM "{}" WHERE "checksum" = ?'.format(
+        PROGRESS), [checksum]).fetchone()
+    if progress is not None and progress[2]:
+        log.info('{} already imported, skipped'.format(file))
+        return
+    done, offset = progress[:2] if progress else (0, None)
+    if progress is None:
+        database_proxy.execute_sql('INSERT INTO "{}" VALUES (?, ?, ?, 0, NULL, 0, ?)'.format(PROGRESS),
+                                   [checksum, file, name, str(datetime.datetime.now())])
+    else:
+        log.info('resuming {} after {} rows'.format(file, done))
+
+    update = 'UPDATE "{}" SET "rows" = ?, "offset" = ?, "done" = ?, "updated" = ? WHERE "checksum" = ?'.format(PROGRESS)
+    position = [done, offset]
+    rows = METRICS.timed(_read_resumable(file, model, fmt, done, offset, position), name, 'convert')
+    while True:
+        with database_proxy.atomic():
+            count = written = 0
+            for batch in _chunks(itertools.islice(rows, checkpoint), bulk_number):
+                with METRICS.timer(name, 'insert', len(batch)):
+                    written += _insert_rows(model, batch, on_conflict)
+                count += len(batch)
+            _add_rows(model, _inserted(written, on_conflict))
+            database_proxy.execute_sql(update, position + [int(count < checkpoint), str(datetime.datetime.now()),
+                                                           checksum])
+            committing = time.perf_counter()
+        METRICS.add(name, 'commit', time.perf_counter() - committing)
+        log.info('{}: {} rows committed'.format(file, position[0]))
+        if count < checkpoint:
+            break
+    if manifest and manifest.get('rows') not in (None, position[0]):
+        log.warning('{}: {} rows imported, the manifest lists {}'.format(file, position[0], manifest['rows']))
+
+
+def _import(folder, bulk_number=100, jobs=1, on_conflict=None, fmt=None, checkpoint=None, tables=None):
+    """Import the files of ``tables`` in ``folder``, TABLES by default, in foreign key order."""
+    tables = tables or TABLES
+    fmt = fmt or _detect_format(folder, tables)
+    if checkpoint:
+        manifest = _load_manifest(folder)
+        for table in tables:
+            file = _table_file(folder, table.name, fmt)
+            _import_checkpointed(file, table, bulk_number, checkpoint, on_conflict, fmt,
+                                 manifest.get(os.path.abspath(file)))
+        return
+    if jobs > 1 and fmt == 'csv':
+        _import_ranges(folder, bulk_number, jobs, on_conflict, tables)
+        return
+    if jobs > 1:
+        _import_parallel(folder, bulk_number, jobs, on_conflict, fmt, tables)
+        return
+    for table in tables:
+        _import_csv(_table_file(folder, table.name, fmt), table.model, bulk_number, on_conflict=on_conflict, fmt=fmt)
+
+
+# A stream is STREAM_MAGIC then frames of a kind byte and a payload length, for every table a
+# start frame (json of table and fieldnames), rows frames (csv text) and an end frame (json of rows
+# and sha256 of the rows payloads), and an end of stream frame. csv.gz and csv.zst compress it all.
+STREAM_MAGIC = b'TOOLSTREAM 1\n'
+STREAM_ROWS = 4096
+STREAM_QUEUE = 16
+FRAME = struct.Struct('>cI')
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+class StreamWriter(object):
+    """Writes table sections one after the other to a single binary stream such as stdout."""
+
+    name = '-'
+
+    def __init__(self, out, fmt='csv'):
+        if fmt in COLUMNAR_FORMATS:
+            raise ValueError('{} cannot be streamed, use csv, csv.gz or csv.zst'.format(fmt))
+        self._out = out
+        if fmt == 'csv.gz':
+            self._f = gzip.GzipFile(fileobj=out, mode='wb')
+        elif fmt == 'csv.zst':
+            self._f = _require('zstandard', fmt).ZstdCompressor().stream_writer(out, closefd=False)
+        else:
+            self._f = out
+        self._f.write(STREAM_MAGIC)
+
+    def __str__(self):
+        return self.name
+
+    def frame(self, kind, payload):
+        self._f.write(FRAME.pack(kind, len(payload)))
+        self._f.write(payload)
+
+    def section(self, model, fieldnames):
+        return StreamSection(self, model, fieldnames)
+
+    def flush(self):
+        """Push everything written so far to the reader, compressed data included."""
+        if self._f is not self._out:
+            self._f.flush()
+        self._out.flush()
+
+    def close(self):
+        self.frame(b'Z', b'')
+        if self._f is not self._out:
+            self._f.close()
+        self._out.flush()
+
+
+class StreamSection(object):
+    """Writes the rows of one table to a ``StreamWriter``, a frame every ``STREAM_ROWS`` rows."""
+
+    def __init__(self, stream, model, fieldnames):
+        self.name = '{}:{}'.format(stream, model._meta.db_table)
+        self._stream = stream
+        self._buffer = io.StringIO()
+        self._writer = csv.DictWriter(self._buffer, fieldnames=fieldnames, quoting=csv.QUOTE_MINIMAL)
+        self._values = csv.writer(self._buffer, quoting=csv.QUOTE_MINIMAL)
+        self._pending = 0
+        self._rows = 0
+        self._digest = hashlib.sha256()
+        stream.frame(b'T', json.dumps({'table': model._meta.db_table, 'fieldnames': list(fieldnames)}).encode())
+
+    def writerow(self, record):
+        self._writer.writerow(record)
+        self._pending += 1
+        if self._pending >= STREAM_ROWS:
+            self._flush()
+
+    def write_values(self, rows):
+        self._values.writerows(rows)
+        self._pending += len(rows)
+        if self._pending >= STREAM_ROWS:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        payload = self._buffer.getvalue().encode('utf-8')
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._digest.update(payload)
+        self._stream.frame(b'R', payload)
+        self._rows += self._pending
+        self._pending = 0
+
+    def close(self):
+        self._flush()
+        self._stream.frame(b'E', json.dumps({'rows': self._rows, 'sha256': self._digest.hexdigest()}).encode())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _read_exact(f, size):
+    data = f.read(size)
+    while len(data) < size:
+        more = f.read(size - len(data))
+        if not more:
+            raise ValueError('stream ended in the middle of a frame')
+        data += more
+    return data
+
+
+def _stream_frames(inp):
+    """Yield the ``(kind, payload)`` frames of a stream, plain or compressed, up to its end frame."""
+    head = inp.peek(4)[:4] if hasattr(inp, 'peek') else b''
+    if head.startswith(GZIP_MAGIC):
+        inp = gzip.GzipFile(fileobj=inp, mode='rb')
+    elif head.startswith(ZSTD_MAGIC):
+        inp = _require('zstandard', 'csv.zst').ZstdDecompressor().stream_reader(inp)
+    if inp.read(len(STREAM_MAGIC)) != STREAM_MAGIC:
+        raise ValueError('not an export stream')
+    while True:
+        header = inp.read(FRAME.size)
+        if not header:
+            raise ValueError('stream ended before its end frame')
+        if len(header) < FRAME.size:
+            header += _read_exact(inp, FRAME.size - len(header))
+        kind, size = FRAME.unpack(header)
+        if kind == b'Z':
+            return
+        yield kind, _read_exact(inp, size) if size else b''
+
+
+def _stream_batches(inp, bulk_number, queue):
+    """Parse the frames of ``inp`` into batches of rows on ``queue``, in a reader thread.
+
+    Puts ``('start', table)``, ``('rows', rows)`` and ``('end', table)`` items, then None at the end
+    of the stream, or the exception that stopped it.
+    """
+    tables = {t.model._meta.db_table: t for t in ALL_TABLES}
+    try:
+        table = convert = digest = None
+        rows = []
+        count = 0
+        for kind, payload in _stream_frames(inp):
+            if kind == b'T':
+                header = json.loads(payload.decode())
+                table = tables.get(header['table'])
+                if table is None:
+                    raise ValueError('unknown table {} in the stream'.format(header['table']))
+                convert = _model_converter(table.model, tuple(header['fieldnames']))
+                digest = hashlib.sha256()
+                count = 0
+                queue.put(('start', table))
+            elif kind == b'R':
+                digest.update(payload)
+                for values in csv.reader(io.StringIO(payload.decode('utf-8'), newline='')):
+                    rows.append(convert(values))
+                    if len(rows) >= bulk_number:
+                        queue.put(('rows', rows))
+                        count += len(rows)
+                        rows = []
+            elif kind == b'E':
+                if rows:
+                    queue.put(('rows', rows))
+                    count += len(rows)
+                    rows = []
+                footer = json.loads(payload.decode())
+                if footer['rows'] != count or footer['sha256'] != digest.hexdigest():
+                    raise ValueError('{} section of the stream is corrupt'.format(table.name))
+                queue.put(('end', table))
+            else:
+                raise ValueError('unknown frame {!r} in the stream'.format(kind))
+    except Exception as e:
+        queue.put(e)
+    else:
+        queue.put(None)
+
+
+def _stream_items(queue):
+    while True:
+        item = queue.get()
+        if item is None:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def _import_stream(inp, bulk_number=100, on_conflict=None, on_commit=None):
+    """Import an export stream, parsing it in a thread while this one inserts.
+
+    Each table section is written in its own transaction, committed once its checksum is verified,
+    and then ``on_commit`` is called, when given.
+    """
+    queue = Queue(maxsize=STREAM_QUEUE)
+    reader = threading.Thread(target=_stream_batches, args=(inp, bulk_number, queue), daemon=True)
+    reader.start()
+    items = _stream_items(queue)
+    for _, table in items:
+        name = table.model._meta.db_table
+        log.info('reading {} from the stream'.format(table.name))
+        count = written = 0
+        with database_proxy.atomic():
+            for event, rows in items:
+                if event == 'end':
+                    break
+                with METRICS.timer(name, 'insert', len(rows)):
+                    written += _insert_rows(table.model, rows, on_conflict)
+                count += len(rows)
+            else:
+                raise ValueError('stream ended inside the {} section'.format(table.name))
+            _add_rows(table.model, _inserted(written, on_conflict))
+            committing = time.perf_counter()
+        METRICS.add(name, 'commit', time.perf_counter() - committing)
+        log.info('{} {} done, {} written'.format(table.name, count, written))
+        if on_commit is not None:
+            on_commit()
+    reader.join()
+
+
+def _export_stream(stream, date=None, hour=None, start=None, end=None, state_file=None, tables=None):
+    """Export a day or hour, a range of days, or the changes since ``state_file`` to a single stream.
+
+    Tables without a time column are exported whole, once.
+    """
+    tables = tables or TABLES
+    if state_file is not None:
+        _check_incremental(tables)
+        state = _load_state(state_file)
+        changed = {}
+        for table in tables:
+            watermark, _ = _export_changes(stream, table, state.get(table.name))
+            if watermark != state.get(table.name):
+                changed[table.name] = watermark
+        stream.close()
+        if changed:
+            state.update(changed)
+            _save_state(state_file, state)
+        return
+    if start is not None:
+        days = []
+        while start < end:
+            days.append(start)
+            start += datetime.timedelta(days=1)
+    else:
+        days = [date]
+    for table in tables:
+        for day in days if _time_field(table.model) is not None else days[:1]:
+            if start is not None:
+                _set_window(day, day + datetime.timedelta(days=1))
+            _export_csv(stream, table.model, table.fieldnames, day, hour)
+    stream.close()
+
+
+class FollowFiles(object):
+    """Rotating output of ``export --follow``, a new ``<start time>`` folder of table files every ``rotate`` seconds.
+
+    A folder is opened with the first rows after the previous one closed, and gets a file for every
+    table and a manifest, so it imports like an incremental export.
+    """
+
+    def __init__(self, directory, tables, fmt='csv', rotate=FOLLOW_ROTATE):
+        self._directory = directory
+        self._tables = tables
+        self._fmt = fmt
+        self._rotate = rotate
+        self._writers = None
+
+    def _open(self):
+        self._folder = os.path.join(self._directory, datetime.datetime.now().strftime('%Y%m%dT%H%M%S.%f'))
+        os.makedirs(self._folder)
+        self._writers = {t.name: _open_writer(_table_file(self._folder, t.name, self._fmt), t.model, t.fieldnames,
+                                              self._fmt) for t in self._tables}
+        self._counts = collections.Counter()
+        self._opened = time.monotonic()
+
+    def write(self, table, rows):
+        if self._writers is None:
+            self._open()
+        self._writers[table.name].write_values(rows)
+        self._counts[table.name] += len(rows)
+
+    def flush(self):
+        for writer in (self._writers or {}).values():
+            writer.flush()
+
+    def rotate(self):
+        """Close the current folder once it is ``rotate`` seconds old."""
+        if self._writers is not None and time.monotonic() - self._opened >= self._rotate:
+            self.close()
+
+    def close(self):
+        if self._writers is None:
+            return
+        for writer in self._writers.values():
+            writer.close()
+        _write_manifest(self._folder, [{'table': name, 'file': writer.name, 'rows': self._counts[name]}
+                                       for name, writer in self._writers.items()], tables=self._tables)
+        log.info('{} closed, {} rows'.format(self._folder, sum(self._counts.values())))
+        self._writers = None
+
+
+def _follow_rows(table, cursor, before, limit=FOLLOW_LIMIT):
+    """The first ``limit`` rows of ``table`` past ``cursor`` and before ``before`` in ``(time, id)`` order, as tuples.
+
+    Returns:
+        The rows, and the cursor of the last one.
+    """
+    model = table.model
+    field = _time_field(model)
+    pk = model._meta.primary_key
+    sql = 'SELECT {0} FROM "{1}" WHERE "{2}" >= ? AND "{2}" < ?'.format(
+        _raw_columns(model, table.fieldnames), model._meta.db_table, field.db_column)
+    params = [cursor['time'], before]
+    if cursor['id'] is not None:
+        sql += ' AND ("{0}" > ? OR "{1}" > ?)'.format(field.db_column, pk.db_column)
+        params += [cursor['time'], cursor['id']]
+    sql += ' ORDER BY "{0}", "{1}" LIMIT ?'.format(field.db_column, pk.db_column)
+    rows = database_proxy.execute_sql(sql, params + [limit]).fetchall()
+    if not rows:
+        return rows, cursor
+    last = rows[-1]
+    return rows, {'time': last[table.fieldnames.index(field.name)], 'id': last[table.fieldnames.index(pk.name)]}
+
+
+def _follow_window(database, start):
+    """Attach the shards from the month of ``start`` on, at most ``SHARD_ATTACH_LIMIT`` of them.
+
+    Returns:
+        The end of the window, None when it holds every shard from there on.
+    """
+    months = _shard_months(database.path, _month(start))
+    end = _next_month(months[SHARD_ATTACH_LIMIT - 1]) if len(months) > SHARD_ATTACH_LIMIT else None
+    database.set_window(_month(start), end)
+    return end
+
+
+def _follow(output, state_file, tables=None, fmt='csv', poll=FOLLOW_POLL, limit=FOLLOW_LIMIT, rotate=FOLLOW_ROTATE,
+            lag=FOLLOW_LAG):
+    """Export the rows of ``tables`` past their ``(time, id)`` cursors as they arrive, until interrupted.
+
+    Each poll reads at most ``limit`` rows per table with an indexed range query, and polls again at
+    once while a table has more. The cursors in ``state_file`` move once the rows are flushed, so a
+    restart may repeat the rows of the last poll but never skips any. Tables without a cursor start
+    at the current hour.
+
+    In a sharded layout, the shards from the month of the oldest cursor on are read, at most
+    ``SHARD_ATTACH_LIMIT`` of them, the window moving on with the cursors and picking up new shards.
+
+    Rows are only read once their ``time`` is ``lag`` seconds old, so that rows of the same moment
+    committed one after the other are read together. Rows committed later than that are not picked
+    up, ``--incremental`` exports by ``updated`` and catches those.
+
+    Args:
+        output: A ``StreamWriter``, or the directory of the ``FollowFiles`` folders.
+        state_file: Json file of the cursors, by table name.
+        tables: Tables to follow, TABLES by default.
+        fmt: csv, csv.gz or csv.zst for the files.
+        poll: Seconds to wait when every table is caught up.
+        limit: Most rows read from a table at a time.
+        rotate: Seconds of rows in each folder.
+        lag: Seconds a row's ``time`` must be in the past before it is read.
+    """
+    tables = tables or TABLES
+    without_time = [t.name for t in tables if _time_field(t.model) is None]
+    if without_time:
+        raise ValueError('cannot follow tables without a time column: {}'.format(', '.join(without_time)))
+    state = _load_state(state_file)
+    hour = str(datetime.datetime.now().replace(minute=0, second=0, microsecond=0))
+    cursors = {t.name: state.get(t.name) or {'time': hour, 'id': None} for t in tables}
+    files = None if isinstance(output, StreamWriter) else FollowFiles(output, tables, fmt, rotate)
+    database = database_proxy.obj
+    log.info('following {} from {}'.format(', '.join(t.name for t in tables), cursors))
+    try:
+        while True:
+            changed = behind = False
+            before = str(datetime.datetime.now() - datetime.timedelta(seconds=lag))
+            window_end = None
+            if isinstance(database, ShardedDatabase):
+                window_end = _follow_window(database, min(_parse_datetime(c['time']) for c in cursors.values()))
+                if window_end is not None and str(window_end) < before:
+                    before = str(window_end)
+                else:
+                    window_end = None
+            for table in tables:
+                name = table.model._meta.db_table
+                with METRICS.timer(name, 'query'):
+                    rows, cursor = _follow_rows(table, cursors[table.name], before, limit)
+                if not rows:
+                    if window_end is not None and cursors[table.name]['time'] < before:
+                        # Every row of the window is read, go on with the next shards.
+                        cursors[table.name] = {'time': before, 'id': None}
+                        changed = behind = True
+                    continue
+                with METRICS.timer(name, 'write', len(rows)):
+                    if files is None:
+                        with output.section(table.model, table.fieldnames) as section:
+                            section.write_values(rows)
+                    else:
+                        files.write(table, rows)
+                log.debug('{}: {} rows up to {}'.format(table.name, len(rows), cursor))
+                cursors[table.name] = cursor
+                changed = True
+                behind = behind or len(rows) == limit
+            if changed:
+                (output if files is None else files).flush()
+                state.update(cursors)
+                _save_state(state_file, state)
+            if files is not None:
+                files.rotate()
+            if not behind:
+                time.sleep(poll)
+    except KeyboardInterrupt:
+        log.info('follow stopped')
+    finally:
+        if files is None:
+            output.close()
+        else:
+            files.close()
+
+
+def _copy_table(table, where, params, on_conflict=None, schema='source'):
+    """Copy the rows of ``table`` matching ``where`` from the attached ``schema`` database in one statement."""
+    model = table.model
+    columns = ', '.join('"{}"'.format(f.db_column) for f in model._meta.sorted_fields)
+    verb = {'ignore': 'INSERT OR IGNORE', 'replace': 'INSERT OR REPLACE'}.get(on_conflict, 'INSERT')
+    sql = '{0} INTO main."{1}" ({2}) SELECT {2} FROM "{4}"."{1}" WHERE {3}'.format(
+        verb, model._meta.db_table, columns, where, schema)
+    if on_conflict == 'update-if-newer':
+        sql += _upsert_clause(model)
+    started = time.perf_counter()
+    with database_proxy.atomic():
+        count = database_proxy.execute_sql(sql, params).rowcount
+        _add_rows(model, _inserted(count, on_conflict))
+    METRICS.add(model._meta.db_table, 'copy', time.perf_counter() - started, count)
+    log.info('{} {} written'.format(table.name, count))
+    return count
+
+
+def _copy_changes(table, watermark=None, on_conflict=None):
+    """Copy the rows of ``table`` changed after ``watermark``, like ``_export_changes``.
+
+    Returns:
+        The new watermark, or ``watermark`` when nothing changed.
+    """
+    where, params = '1', []
+    if watermark:
+        where = '"updated" >= ? AND ("updated" > ? OR "id" > ?)'
+        params = [watermark['updated'], watermark['updated'], watermark['id']]
+    cursor = database_proxy.execute_sql(
+        'SELECT "updated", "id" FROM source."{0}" WHERE {1} ORDER BY "updated" DESC, "id" DESC LIMIT 1'.format(
+            table.model._meta.db_table, where), params)
+    last = cursor.fetchone()
+    if last is None:
+        log.info('{} unchanged'.format(table.name))
+        return watermark
+    # Stop at the watermark read above, rows written meanwhile are left for the next run.
+    _copy_table(table, where + ' AND ("updated" < ? OR ("updated" = ? AND "id" <= ?))',
+                params + [last[0], last[0], last[1]], on_conflict)
+    return {'updated': last[0], 'id': last[1]}
+
+
+def _copy(source, start=None, end=None, on_conflict=None, state_file=None):
+    """Copy the tables from the ``source`` database file into the current one without leaving SQLite.
+
+    The shards of a sharded ``source`` that overlap the time window are attached and copied too.
+
+    Args:
+        source: Path of the database to read.
+        start: Start of the ``[start, end)`` time window.
+        end: End of the window.
+        on_conflict: None to fail on existing ids, or one of ``ON_CONFLICT``.
+        state_file: Copy the rows changed since the watermarks in this file instead of a time window.
+    """
+    months = _shard_months(source, start, end) if state_file is None and _sharded(source) else []
+    database_proxy.execute_sql('ATTACH DATABASE ? AS source', (source,))
+    try:
+        if state_file is not None:
+            state = _load_state(state_file)
+            for table in TABLES:
+                watermark = _copy_changes(table, state.get(table.name), on_conflict)
+                if watermark is not None:
+                    state[table.name] = watermark
+                    _save_state(state_file, state)
+            return
+        log.info('copy from {} to {}'.format(start, end))
+        # The source takes one of the attached databases, its shards are attached a group of the others at a time.
+        for group, main in _shard_groups(months, SHARD_ATTACH_LIMIT - 1):
+            schemas = ['source'] * main
+            try:
+                for month in group:
+                    schema = 'source_' + month.strftime('%Y_%m')
+                    database_proxy.execute_sql('ATTACH DATABASE ? AS "{}"'.format(schema),
+                                               [_shard_file(source, month)])
+                    schemas.append(schema)
+                for table in TABLES:
+                    for schema in schemas:
+                        _copy_table(table, '"time" >= ? AND "time" < ?', [str(start), str(end)], on_conflict,
+                                    schema)
+            finally:
+                for schema in reversed(schemas[main:]):
+                    database_proxy.execute_sql('DETACH DATABASE "{}"'.format(schema))
+    finally:
+        database_proxy.execute_sql('DETACH DATABASE source')
+
+
+Rollup = collections.namedtuple('Rollup', ['name', 'source', 'report', 'area', 'columns'])
+
+# Upper bounds of age_cat1..7, age_cat8 takes the rest.
+AGE_CATEGORIES = [10, 20, 30, 40, 50, 60, 70]
+GENDER_MALE = 1
+GENDER_FEMALE = 0
+
+ROLLUPS = [
+    Rollup('heatmap', HeatmapHeatvalue, HeatmapHeatmapreport, 'r."area_id"', [('hot', 'SUM(v."hot")')]),
+    Rollup('staymap', HeatmapStayvalue, HeatmapStaymapreport, 'r."area_id"', [('stay', 'SUM(v."stay")')]),
+    Rollup('flow', FlowFlow, FlowFlowreport, 'v."area_id"',
+           [('flow_in', 'SUM(v."flow_in")'), ('flow_out', 'SUM(v."flow_out")')]),
+    Rollup('people', PeoplePerson, PeoplePeoplereport, 'v."area_id"',
+           [('age_cat{}'.format(i + 1), 'SUM({})'.format(' AND '.join(bounds)))
+            for i, bounds in enumerate([['v."age" < {}'.format(AGE_CATEGORIES[0])]] +
+                                       [['v."age" >= {}'.format(low), 'v."age" < {}'.format(high)]
+                                        for low, high in zip(AGE_CATEGORIES, AGE_CATEGORIES[1:])] +
+                                       [['v."age" >= {}'.format(AGE_CATEGORIES[-1])]])] +
+           [('gender_male', 'SUM(v."gender" = {})'.format(GENDER_MALE)),
+            ('gender_female', 'SUM(v."gender" = {})'.format(GENDER_FEMALE))]),
+]
+HOUR_FORMAT = '%Y-%m-%d %H:00:00'
+
+
+def _rollup_hours(rollup, start, end, now):
+    """Recompute the report rows of the hours in ``[start, end)`` with one GROUP BY pass.
+
+    Existing report rows are updated in place, new (area, hour) pairs are inserted, and
+    report rows left without any raw value are soft deleted.
+
+    Returns:
+        Number of (area, hour) aggregates.
+    """
+    source = rollup.source._meta.db_table
+    report = rollup.report._meta.db_table
+    area = rollup.report.area.db_column
+    hour = rollup.report.hour.db_column
+    names = [name for name, _ in rollup.columns]
+    join = ''
+    if rollup.area.startswith('r.'):
+        join = 'JOIN "{}" r ON r."id" = v."{}" AND r."area_id" IS NOT NULL'.format(
+            ShopRectangle._meta.db_table, rollup.source.rect.db_column)
+    database_proxy.execute_sql('DROP TABLE IF EXISTS temp."rollup"')
+    database_proxy.execute_sql(
+        'CREATE TEMP TABLE "rollup" AS SELECT {area} AS "area", strftime(\'{fmt}\', v."time") AS "hour", {aggs} '
+        'FROM "{source}" v {join} WHERE v."time" >= ? AND v."time" < ? AND NOT v."is_deleted" '
+        'GROUP BY 1, 2'.format(area=rollup.area, fmt=HOUR_FORMAT, source=source, join=join,
+                               aggs=', '.join('{} AS "{}"'.format(expr, name) for name, expr in rollup.columns)),
+        [str(start), str(end)])
+    count = database_proxy.execute_sql('SELECT COUNT(*) FROM temp."rollup"').fetchone()[0]
+    database_proxy.execute_sql(
+        'UPDATE "{report}" SET {sets}, "updated" = ?, "is_deleted" = 0, "deleted_time" = NULL FROM temp."rollup" t '
+        'WHERE "{report}"."{area}" = t."area" AND "{report}"."{hour}" = t."hour"'.format(
+            report=report, area=area, hour=hour, sets=', '.join('"{0}" = t."{0}"'.format(n) for n in names)),
+        [now])
+    inserted = database_proxy.execute_sql(
+        'INSERT INTO "{report}" ("id", "{area}", "{hour}", {columns}, "created", "updated", "is_deleted") '
+        'SELECT lower(hex(randomblob(16))), t."area", t."hour", {values}, ?, ?, 0 FROM temp."rollup" t '
+        'WHERE NOT EXISTS (SELECT 1 FROM "{report}" x WHERE x."{area}" = t."area" AND x."{hour}" = t."hour")'.format(
+            report=report, area=area, hour=hour, columns=', '.join('"{}"'.format(n) for n in names),
+            values=', '.join('t."{}"'.format(n) for n in names)),
+        [now, now]).rowcount
+    _add_rows(rollup.report, inserted)
+    database_proxy.execute_sql(
+        'UPDATE "{report}" SET "is_deleted" = 1, "deleted_time" = ?, "updated" = ? '
+        'WHERE "{hour}" >= ? AND "{hour}" < ? AND NOT "is_deleted" AND NOT EXISTS '
+        '(SELECT 1 FROM temp."rollup" t WHERE t."area" = "{report}"."{area}" AND t."hour" = "{report}"."{hour}")'.format(
+            report=report, area=area, hour=hour),
+        [now, now, start.strftime(HOUR_FORMAT), end.strftime(HOUR_FORMAT)])
+    database_proxy.execute_sql('DROP TABLE temp."rollup"')
+    return count
+
+
+def _hour_ranges(hours):
+    """Merge sorted hour strings into ``[start, end)`` datetime ranges of consecutive hours."""
+    ranges = []
+    for text in hours:
+        hour = datetime.datetime.strptime(text, HOUR_FORMAT)
+        if ranges and ranges[-1][1] == hour:
+            ranges[-1][1] = hour + datetime.timedelta(hours=1)
+        else:
+            ranges.append([hour, hour + datetime.timedelta(hours=1)])
+    return ranges
+
+
+TOUCHED_HOURS = 'tool_touched_hour'
+
+
+def _track_touched_hours(models, deletes=False):
+    """Create the table of touched hours, and the triggers of the ``models`` tables that fill it, unless they exist.
+
+    Every insert or update of a row, whoever writes it, records the hour the row is in, and the hour it left when
+    its time changed, with a new ``seq``. ``deletes`` records the hours of deleted rows as well: not for the raw
+    values, which compact deletes while their reports stay. The table keeps a row per table and hour.
+    """
+    record = ('INSERT OR REPLACE INTO "{touched}" ("table", "hour") SELECT \'{table}\', '
+              'strftime(\'{fmt}\', {row}."{time}") WHERE {row}."{time}" IS NOT NULL{where}')
+    with database_proxy.atomic():
+        database_proxy.execute_sql(
+            'CREATE TABLE IF NOT EXISTS main."{}" ("seq" INTEGER PRIMARY KEY AUTOINCREMENT, "table" TEXT NOT NULL, '
+            '"hour" TEXT NOT NULL, UNIQUE ("table", "hour"))'.format(TOUCHED_HOURS))
+        for model in models:
+            table, column = model._meta.db_table, _time_field(model).db_column
+            new, old, gone = [record.format(touched=TOUCHED_HOURS, table=table, fmt=HOUR_FORMAT, row=row, time=column,
+                                            where=where)
+                              for row, where in [('NEW', ''), ('OLD', ' AND OLD."{0}" IS NOT NEW."{0}"'.format(column)),
+                                                 ('OLD', '')]]
+            triggers = [('insert', new), ('update', '{}; {}'.format(new, old))] + ([('delete', gone)] if deletes else [])
+            for event, body in triggers:
+                database_proxy.execute_sql(
+                    'CREATE TRIGGER IF NOT EXISTS main."{0}_touched_{1}" AFTER {2} ON "{0}" BEGIN {3}; END'.format(
+                        table, event, event.upper(), body))
+
+
+def _touched_hours(rollup, seq=None):
+    """Hours with raw rows written after ``seq`` of the touched hours table, and the new ``seq``.
+
+    Without ``seq``, every hour holding raw rows. Soft deletes are updates, so their hours are found as well.
+    """
+    last = database_proxy.execute_sql('SELECT MAX("seq") FROM main."{}"'.format(TOUCHED_HOURS)).fetchone()[0] or 0
+    source = rollup.source._meta.db_table
+    if seq is not None:
+        cursor = database_proxy.execute_sql(
+            'SELECT "hour" FROM main."{}" WHERE "table" = ? AND "seq" > ? AND "seq" <= ?'.format(TOUCHED_HOURS),
+            [source, seq, last])
+        return sorted(row[0] for row in cursor), last
+    database = database_proxy.obj
+    groups = [None]
+    if isinstance(database, ShardedDatabase):
+        groups = _shard_groups(_changed_shards(database.path, rollup.source, None)[0])
+    hours = set()
+    for group in groups:
+        if group is not None:
+            database.set_months(*group)
+        cursor = database_proxy.execute_sql(
+            'SELECT DISTINCT strftime(\'{}\', "time") FROM "{}"'.format(HOUR_FORMAT, source))
+        hours.update(row[0] for row in cursor if row[0] is not None)
+    return sorted(hours), last
+
+
+def _window_groups(ranges):
+    """Split sorted ``[start, end)`` ranges into groups spanning at most ``SHARD_ATTACH_LIMIT`` months.
+
+    Returns:
+        List of ``(window, ranges)``, the window being the ``(start, end)`` of whole months holding the ranges.
+    """
+    groups = []
+    for start, end in ranges:
+        while start < end:
+            month = _month(start)
+            piece = [start, min(end, _next_month(month))]
+            if groups and (month.year - groups[-1][0].year) * 12 + month.month - groups[-1][0].month < \
+                    SHARD_ATTACH_LIMIT:
+                groups[-1][1].append(piece)
+            else:
+                groups.append((month, [piece]))
+            start = piece[1]
+    return [((first, _next_month(_month(pieces[-1][0]))), pieces) for first, pieces in groups]
+
+
+def _rollup(start=None, end=None, state_file=None):
+    """Fill the report tables with hourly per-area aggregates of the raw values.
+
+    Args:
+        start: Start of a ``[start, end)`` window to recompute.
+        end: End of the window.
+        state_file: Recompute only the hours touched since the ``seq`` in this file, and move it. A file
+            without one, new or from an older version, recomputes every hour.
+    """
+    state = _load_state(state_file) if state_file is not None else {}
+    # serve drops the cached answers of the report hours these record.
+    _track_touched_hours([m for m in REPORT_MODELS + [ProductProductreport] if _has_table(m._meta.db_table)],
+                         deletes=True)
+    if state_file is not None:
+        _track_touched_hours([r.source for r in ROLLUPS])
+    for rollup in ROLLUPS:
+        if state_file is not None:
+            seq = state.get(rollup.name)
+            # Older versions kept an updated watermark here, which missed the rows import and copy write.
+            hours, watermark = _touched_hours(rollup, seq if isinstance(seq, int) else None)
+            ranges = _hour_ranges(hours)
+        else:
+            watermark = None
+            ranges = [[start, end]]
+        now = str(datetime.datetime.now())
+        count = 0
+        started = time.perf_counter()
+        database = database_proxy.obj
+        # A sharded layout rolls up a window of shards at a time, each in its own transaction.
+        groups = _window_groups(ranges) if isinstance(database, ShardedDatabase) else [(None, ranges)]
+        for window, group in groups:
+            if window is not None:
+                database.set_window(*window)
+            with database_proxy.atomic():
+                for range_start, range_end in group:
+                    count += _rollup_hours(rollup, range_start, range_end, now)
+        METRICS.add(rollup.report._meta.db_table, 'rollup', time.perf_counter() - started, count)
+        log.info('{}: {} hour ranges, {} area hours rolled up'.format(rollup.name, len(ranges), count))
+        if watermark is not None:
+            state[rollup.name] = watermark
+            _save_state(state_file, state)
+
+
+COMPACT_TABLES = ['heatmap', 'staymap']
+
+
+def _unreported_hour(rollup, cutoff):
+    """Earliest hour before ``cutoff`` holding raw values without a report row for their area, or None."""
+    cursor = database_proxy.execute_sql(
+        'SELECT MIN(strftime(\'{fmt}\', v."time")) FROM "{source}" v '
+        'JOIN "{rect}" r ON r."id" = v."{rect_id}" AND r."area_id" IS NOT NULL '
+        'WHERE v."time" < ? AND NOT v."is_deleted" AND NOT EXISTS (SELECT 1 FROM "{report}" x '
+        'WHERE x."{hour}" = strftime(\'{fmt}\', v."time") AND x."{area}" = r."area_id" AND NOT x."is_deleted")'.format(
+            fmt=HOUR_FORMAT, source=rollup.source._meta.db_table, rect=ShopRectangle._meta.db_table,
+            rect_id=rollup.source.rect.db_column, report=rollup.report._meta.db_table,
+            hour=rollup.report.hour.db_column, area=rollup.report.area.db_column),
+        [str(cutoff)])
+    hour = cursor.fetchone()[0]
+    return hour and datetime.datetime.strptime(hour, HOUR_FORMAT)
+
+
+def _purge(table, cutoff, batch_size=COMPACT_BATCH_SIZE):
+    """Delete the rows of ``table`` older than ``cutoff``, ``batch_size`` rows per transaction."""
+    sql = 'DELETE FROM "{0}" WHERE rowid IN (SELECT rowid FROM "{0}" WHERE "time" < ? LIMIT ?)'.format(
+        table.model._meta.db_table)
+    count = 0
+    while True:
+        with database_proxy.atomic():
+            deleted = database_proxy.execute_sql(sql, [str(cutoff), batch_size]).rowcount
+            _add_rows(table.model, -deleted)
+        count += deleted
+        if deleted < batch_size:
+            return count
+
+
+def _fsync(path):
+    """Flush a file or directory to disk. Windows cannot open directories for it."""
+    if os.name == 'nt' and os.path.isdir(path):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _row_signature(model):
+    """SQL text of every column of a ``model`` row, equal for two rows only when all their values are."""
+    return " || ',' || ".join('quote("{}")'.format(f.db_column) for f in model._meta.sorted_fields)
+
+
+def _archive(table, cutoff, file, fmt='csv.gz', batch_size=COMPACT_BATCH_SIZE):
+    """Move the rows of ``table`` older than ``cutoff`` to ``file``, ``batch_size`` rows per transaction.
+
+    The file is written, closed and synced to disk before the first row is deleted, so a crash can leave
+    rows both archived and still in the database, but never lose them. The ids and values of the archived
+    rows are kept in a temporary table meanwhile, by rowid, and a row another writer changed since it was
+    archived stays in the database.
+
+    Returns:
+        Numbers of rows archived and deleted.
+    """
+    model = table.model
+    name = model._meta.db_table
+    signature = _row_signature(model)
+    database_proxy.execute_sql('DROP TABLE IF EXISTS temp."archived"')
+    database_proxy.execute_sql('CREATE TEMP TABLE "archived" ("row" INTEGER PRIMARY KEY, "signature" TEXT)')
+    count, last = 0, None
+    with _open_writer(file, model, table.fieldnames, fmt) as writer:
+        while True:
+            with database_proxy.atomic():
+                query = model.select().where(model.time < cutoff)
+                if last is not None:
+                    query = query.where((model.time > last['time']) |
+                                        ((model.time == last['time']) & (model.id > last['id'])))
+                batch = list(query.order_by(model.time, model.id).limit(batch_size).dicts())
+                if not batch:
+                    break
+                first, last = batch[0], batch[-1]
+                database_proxy.execute_sql(
+                    'INSERT INTO temp."archived" SELECT rowid, {} FROM "{}" WHERE "time" < ? '
+                    'AND ("time" > ? OR ("time" = ? AND "id" >= ?)) '
+                    'AND ("time" < ? OR ("time" = ? AND "id" <= ?))'.format(signature, name),
+                    [str(cutoff), str(first['time']), str(first['time']), first['id'],
+                     str(last['time']), str(last['time']), last['id']])
+            for record in batch:
+                writer.writerow(record)
+            count += len(batch)
+    _fsync(file)
+    _fsync(os.path.dirname(file))
+
+    deleted, after = 0, None
+    while True:
+        with database_proxy.atomic():
+            upto = database_proxy.execute_sql(
+                'SELECT MAX("row") FROM (SELECT "row" FROM temp."archived" WHERE "row" > ? ORDER BY "row" LIMIT ?)',
+                [-1 if after is None else after, batch_size]).fetchone()[0]
+            if upto is None:
+                break
+            removed = database_proxy.execute_sql(
+                'DELETE FROM "{0}" WHERE rowid > ? AND rowid <= ? AND {1} = '
+                '(SELECT a."signature" FROM temp."archived" a WHERE a."row" = "{0}".rowid)'.format(name, signature),
+                [-1 if after is None else after, upto]).rowcount
+            _add_rows(model, -removed)
+        deleted += removed
+        after = upto
+    database_proxy.execute_sql('DROP TABLE temp."archived"')
+    return count, deleted
+
+
+def _incremental_vacuum(enable=False):
+    """Give the free pages back to the file system, a chunk at a time.
+
+    Only databases with ``auto_vacuum = INCREMENTAL`` keep track of free pages for this.
+    ``enable`` switches the setting on, which takes one full VACUUM.
+    """
+    if _pragma('auto_vacuum') != 2:
+        if not enable:
+            log.warning('auto_vacuum is not incremental, the file keeps its size. '
+                        'Use --enable-auto-vacuum once to switch it on')
+            return
+        log.info('enabling incremental auto_vacuum, rewriting the database')
+        _pragma('auto_vacuum', 'incremental')
+        database_proxy.execute_sql('VACUUM')
+        return
+    pages = _pragma('freelist_count')
+    while True:
+        free = _pragma('freelist_count')
+        if not free:
+            break
+        # A cursor steps the pragma once, releasing a single page. executescript runs it to the end.
+        database_proxy.get_conn().executescript('PRAGMA incremental_vacuum({})'.format(min(free, 1024)))
+    log.info('{} pages released'.format(pages))
+
+
+def _compact(cutoff, archive=None, fmt='csv.gz', check_reports=False, batch_size=COMPACT_BATCH_SIZE,
+             enable_auto_vacuum=False):
+    """Remove the raw heat and stay values older than ``cutoff``, then vacuum.
+
+    Args:
+        cutoff: Rows whose ``time`` is before it go.
+        archive: Directory to write the removed rows to, in a new ``<run time>/`` folder, instead of dropping them.
+        fmt: Format of the archive, one of ``FORMATS``.
+        check_reports: Stop each table at its first hour that has no report row yet.
+        batch_size: Rows deleted per transaction, so writers are only held up briefly.
+        enable_auto_vacuum: Switch the database to incremental auto_vacuum if needed.
+
+    Returns:
+        The archive folder written, or None.
+    """
+    rollups = {r.name: r for r in ROLLUPS}
+    folder = None
+    if archive is not None:
+        folder = os.path.join(archive, datetime.datetime.now().strftime('%Y%m%dT%H%M%S.%f'))
+        os.makedirs(folder)
+    for table in TABLES:
+        file = folder and _table_file(folder, table.name, fmt)
+        if table.name not in COMPACT_TABLES:
+            if folder is not None:
+                # Header only, so the folder imports like an export.
+                _open_writer(file, table.model, table.fieldnames, fmt).close()
+            continue
+        end = cutoff
+        if check_reports:
+            hour = _unreported_hour(rollups[table.name], cutoff)
+            if hour is not None:
+                log.warning('{}: no report for {}, keeping the rows from there on'.format(table.name, hour))
+                end = min(end, hour)
+        started = time.perf_counter()
+        if folder is not None:
+            count, deleted = _archive(table, end, file, fmt, batch_size)
+            METRICS.add(table.model._meta.db_table, 'archive', time.perf_counter() - started, count)
+            log.info('{}: {} rows before {} archived to {}'.format(table.name, count, end, file))
+            if deleted < count:
+                log.warning('{}: {} archived rows changed meanwhile, kept in the database'.format(
+                    table.name, count - deleted))
+        else:
+            count = _purge(table, end, batch_size)
+            METRICS.add(table.model._meta.db_table, 'delete', time.perf_counter() - started, count)
+            log.info('{}: {} rows before {} deleted'.format(table.name, count, end))
+    with METRICS.timer('all', 'vacuum'):
+        _incremental_vacuum(enable_auto_vacuum)
+    return folder
+
+
+TIME_INDEXED_MODELS = [HeatmapHeatvalue, HeatmapStayvalue, FlowFlow, PeoplePerson]
+REPORT_MODELS = [HeatmapHeatmapreport, HeatmapStaymapreport, FlowFlowreport, PeoplePeoplereport]
+# time serves date and range exports, (updated, id) incremental export, (hour, area) the report updates and serve
+# queries.
+INDEXES = ([(model, columns) for model in TIME_INDEXED_MODELS for columns in [('time',), ('updated', 'id')]] +
+           [(model, ('hour', 'area')) for model in REPORT_MODELS] + [(ProductProductreport, ('hour', 'sku'))])
+# Tables older schemas lack, whose indexes are skipped when they do.
+OPTIONAL_INDEXED_MODELS = [ProductProductreport]
+
+
+def _find_index(model, columns):
+    """Name of an existing index led by ``columns``, or None."""
+    db_columns = [model._meta.fields[c].db_column for c in columns]
+    for index in database_proxy.get_indexes(model._meta.db_table):
+        if index.columns[:len(db_columns)] == db_columns:
+            return index.name
+    return None
+
+
+def _index(create=False):
+    """Check, and optionally create, the indexes used by export and rollup.
+
+    Args:
+        create: Create missing indexes.
+
+    Returns:
+        List of ``table(columns)`` still lacking an index, or their table.
+    """
+    missing = []
+    for model, columns in INDEXES:
+        label = '{}({})'.format(model._meta.db_table, ', '.join(columns))
+        if not _has_table(model._meta.db_table):
+            if model in OPTIONAL_INDEXED_MODELS:
+                log.info('{}: no table'.format(label))
+            else:
+                log.error('{}: no table'.format(label))
+                missing.append(label)
+            continue
+        name = _find_index(model, columns)
+        if name is None and create:
+            log.info('creating index on {}'.format(label))
+            with database_proxy.atomic():
+                database_proxy.create_index(model, list(columns))
+            name = _find_index(model, columns)
+        if name is None:
+            log.warning('{}: no index'.format(label))
+            missing.append(label)
+        else:
+            log.info('{}: index {}'.format(label, name))
+    return missing
+
+
+def _update_registry():
+    """Write the column registry ``tool.py`` exports days and hours from, when the models or this file changed."""
+    registry.save([{'name': t.name, 'model': t.model.__name__, 'table': t.model._meta.db_table,
+                    'fieldnames': t.fieldnames, 'columns': _raw_columns(t.model, t.fieldnames),
+                    'time': None if _time_field(t.model) is None else _time_field(t.model).db_column}
+                   for t in TABLES])
+
+
+def run(args, parser):
+    """Run the command parsed from the command line by ``parser``, which reports usage errors."""
+    _configure(args)
+    _update_registry()
+    if args.profile == 'cpu':
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+
+        def _report_cpu():
+            profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(30)
+            sys.stderr.write('cpu profile:\n{}'.format(out.getvalue()))
+            if args.profile_output is not None:
+                profiler.dump_stats(args.profile_output)
+        atexit.register(_report_cpu)
+        profiler.enable()
+    elif args.profile == 'memory':
+        import tracemalloc
+        tracemalloc.start()
+
+        def _report_memory():
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            sys.stderr.write('memory profile, peak {} bytes traced:\n{}\n'.format(
+                peak, '\n'.join(str(stat) for stat in snapshot.statistics('lineno')[:30])))
+            if args.profile_output is not None:
+                snapshot.dump(args.profile_output)
+        atexit.register(_report_memory)
+
+    if args.cmd in CMDS[:2]:
+        try:
+            tables = _select_tables(args.tables)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.cmd == CMDS[0]:
+
+        if args.follow is not None:
+            fmt = _resolve_format(args.format)
+            if args.jobs > 1 or fmt in COLUMNAR_FORMATS:
+                parser.error('--follow writes csv, csv.gz or csv.zst from a single process')
+            log.info('{} from {}'.format(args.cmd, args.sqlite))
+            _open_database(args.sqlite, readonly=True, window=(None, None))
+            # Stop on SIGTERM as on Ctrl-C, closing the files and the stream cleanly.
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            output = StreamWriter(sys.stdout.buffer, fmt) if args.output == '-' else args.output
+            _follow(output, args.follow, tables, fmt, poll=args.poll, limit=args.limit, rotate=args.rotate,
+                    lag=args.lag)
+        elif args.output == '-' and (args.incremental is not None or args.date_from is not None or
+                                   args.date is not None):
+            if args.jobs > 1:
+                parser.error('a stream is written by a single process, it cannot be combined with --jobs')
+            log.info('{} from {} to stdout'.format(args.cmd, args.sqlite))
+            stream = StreamWriter(sys.stdout.buffer, _resolve_format(args.format))
+            if args.date_from is not None:
+                start = datetime.datetime.strptime(args.date_from, '%Y-%m-%d')
+                end = datetime.datetime.strptime(args.date_to or args.date_from, '%Y-%m-%d') + datetime.timedelta(days=1)
+                _open_database(args.sqlite, readonly=True, window=(None, None))
+                _export_stream(stream, start=start, end=end, tables=tables)
+            elif args.date is not None and args.incremental is None:
+                d = datetime.datetime.strptime(args.date, '%Y-%m-%d')
+                if args.hour is not None:
+                    d = d.replace(hour=args.hour)
+                _open_database(args.sqlite, readonly=True, window=_time_range(d, args.hour))
+                _export_stream(stream, d, args.hour, tables=tables)
+            else:
+                _open_database(args.sqlite, readonly=True, window=(None, None))
+                _export_stream(stream, state_file=args.incremental, tables=tables)
+        elif args.incremental is not None and args.output is not None:
+            log.info('{} from {}'.format(args.cmd, args.sqlite))
+            _open_database(args.sqlite, readonly=True, window=(None, None))
+            _export_incremental(args.output, args.incremental, _resolve_format(args.format), stats=args.stats,
+                                tables=tables)
+        elif args.date_from is not None and args.output is not None:
+            log.info('{} from {}'.format(args.cmd, args.sqlite))
+            start = datetime.datetime.strptime(args.date_from, '%Y-%m-%d')
+            end = datetime.datetime.strptime(args.date_to or args.date_from, '%Y-%m-%d') + datetime.timedelta(days=1)
+            _open_database(args.sqlite, readonly=True, window=(None, None))
+            _export_range(args.output, start, end, args.partition, jobs=args.jobs, sqlite=args.sqlite,
+                          fmt=_resolve_format(args.format), stats=args.stats, tables=tables)
+        elif args.date is not None and args.output is not None:
+            log.info('{} from {}'.format(args.cmd, args.sqlite))
+            d = datetime.datetime.strptime(args.date, '%Y-%m-%d')
+            _open_database(args.sqlite, readonly=True, window=_time_range(d, args.hour))
+            if args.hour is not None:
+                d = datetime.datetime.strptime('{0} {1}'.format(args.date, args.hour), '%Y-%m-%d %H')
+                _export(args.output, d, args.hour, jobs=args.jobs, sqlite=args.sqlite, fmt=_resolve_format(args.format),
+                        stats=args.stats, tables=tables)
+            else:
+                _export(args.output, d, jobs=args.jobs, sqlite=args.sqlite, fmt=_resolve_format(args.format),
+                        stats=args.stats, tables=tables)
+        else:
+            parser.print_help()
+    elif args.cmd == CMDS[1]:
+        if args.checkpoint and args.jobs > 1:
+            parser.error('--checkpoint imports one file at a time, it cannot be combined with --jobs')
+        if args.input == '-':
+            if args.checkpoint or args.jobs > 1:
+                parser.error('a stream is imported in one pass, it cannot be combined with --checkpoint or --jobs')
+            log.info('{} from stdin to {}'.format(args.cmd, args.sqlite))
+            _open_database(args.sqlite)
+            route = functools.partial(_route_to_shards, args.sqlite, args.on_conflict) if _sharded(args.sqlite) else None
+            with _fast_load([t.model for t in tables], args.drop_indexes) if args.fast_load else contextlib.nullcontext():
+                _import_stream(sys.stdin.buffer, args.bulk, on_conflict=args.on_conflict, on_commit=route)
+        elif args.input is not None:
+            log.info('{} to {}'.format(args.cmd, args.sqlite))
+            _open_database(args.sqlite)
+            with _fast_load([t.model for t in tables], args.drop_indexes) if args.fast_load else contextlib.nullcontext():
+                _import(args.input, args.bulk, jobs=args.jobs, on_conflict=args.on_conflict,
+                        fmt=args.format and _resolve_format(args.format), checkpoint=args.checkpoint, tables=tables)
+            if _sharded(args.sqlite):
+                _route_to_shards(args.sqlite, args.on_conflict)
+        else:
+            parser.print_help()
+    elif args.cmd == CMDS[2]:
+        _open_database(args.sqlite)
+        if _index(create=args.create):
+            sys.exit(1)
+    elif args.cmd == CMDS[3]:
+        if args.incremental is not None or args.date_from is not None or args.date is not None:
+            if args.incremental is not None and _sharded(args.sqlite):
+                parser.error('an incremental copy reads the main database only, export and import a sharded '
+                             'database instead')
+            log.info('{} from {} to {}'.format(args.cmd, args.sqlite, args.target))
+            _open_database(args.target)
+            start = end = None
+            if args.incremental is not None:
+                pass
+            elif args.date_from is not None:
+                start = datetime.datetime.strptime(args.date_from, '%Y-%m-%d')
+                end = datetime.datetime.strptime(args.date_to or args.date_from, '%Y-%m-%d') + datetime.timedelta(days=1)
+            else:
+                start, end = _time_range(datetime.datetime.strptime(args.date, '%Y-%m-%d'), args.hour)
+            with _fast_load([t.model for t in TABLES], args.drop_indexes) if args.fast_load else contextlib.nullcontext():
+                _copy(args.sqlite or DEFAULT_SQLITE_FILE, start, end, on_conflict=args.on_conflict,
+                      state_file=args.incremental)
+            if _sharded(args.target):
+                _route_to_shards(args.target, args.on_conflict)
+        else:
+            parser.print_help()
+    elif args.cmd == CMDS[4]:
+        if args.incremental is not None or args.date_from is not None or args.date is not None:
+            log.info('{} in {}'.format(args.cmd, args.sqlite))
+            start = end = None
+            if args.incremental is not None:
+                pass
+            elif args.date_from is not None:
+                start = datetime.datetime.strptime(args.date_from, '%Y-%m-%d')
+                end = datetime.datetime.strptime(args.date_to or args.date_from, '%Y-%m-%d') + datetime.timedelta(days=1)
+            else:
+                start, end = _time_range(datetime.datetime.strptime(args.date, '%Y-%m-%d'), args.hour)
+            # The shards are attached a window at a time.
+            _open_database(args.sqlite, window=(None, None))
+            _rollup(start, end, state_file=args.incremental)
+        else:
+            parser.print_help()
+    elif args.cmd == CMDS[5]:
+        if args.date_from is not None or args.date is not None:
+            import grid
+            if args.date_from is not None:
+                start = datetime.datetime.strptime(args.date_from, '%Y-%m-%d')
+                end = datetime.datetime.strptime(args.date_to or args.date_from, '%Y-%m-%d') + datetime.timedelta(days=1)
+            else:
+                start, end = _time_range(datetime.datetime.strptime(args.date, '%Y-%m-%d'), args.hour)
+            _open_database(args.sqlite, readonly=True, window=(None, None))
+            rects = grid.load_rects()
+            parts = []
+            for first, last in _window_pieces(start, end):
+                _set_window(first, last)
+                parts.append(grid.build_rect_grids(args.value, first, last, rects))
+            grids = grid.join_hours(parts)
+            if args.floor:
+                grids = grid.project_to_floors(grids, rects)
+            grid.save_grids(args.output, grids, sparse=args.sparse)
+            log.info('{} grids saved to {}'.format(len(grids), args.output))
+        else:
+            parser.print_help()
+    elif args.cmd == CMDS[6]:
+        if _sharded(args.sqlite):
+            parser.error('a sharded database drops old values by deleting the files of their months in {}'.format(
+                _shard_dir(args.sqlite)))
+        if args.archive is not None and _resolve_format(args.format) == 'npz':
+            parser.error('npz holds the whole archive in memory until it is closed, archive to csv.gz, csv.zst, '
+                         'csv or parquet')
+        log.info('{} {}'.format(args.cmd, args.sqlite))
+        _open_database(args.sqlite)
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        _compact(today - datetime.timedelta(days=args.older_than), args.archive, _resolve_format(args.format),
+                 check_reports=args.check_reports, batch_size=args.batch,
+                 enable_auto_vacuum=args.enable_auto_vacuum)
+    elif args.cmd == CMDS[7]:
+        import bench
+        results = bench.run(args.rows, args.areas, args.rects, args.days, args.seed, _resolve_format(args.format),
+                            database=args.database, workdir=args.workdir, only=args.only)
+        if args.output is not None:
+            bench.save(args.output, results)
+        else:
+            json.dump(results, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
+        if args.baseline is not None:
+            with open(args.baseline) as f:
+                regressions = bench.compare(results, json.load(f), args.tolerance)
+            for regression in regressions:
+                log.warning(regression)
+            if regressions:
+                sys.exit(1)
+    elif args.cmd == CMDS[8]:
+        log.info('{} {}'.format(args.cmd, args.sqlite))
+        _open_database(args.sqlite)
+        _shard(args.sqlite, args.on_conflict)
+    elif args.cmd == CMDS[9]:
+        import serve
+        # Stop on SIGTERM as on Ctrl-C.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        serve.serve(args.sqlite or DEFAULT_SQLITE_FILE, args.host, args.port, args.connections, args.cache_size,
+                    args.ttl, args.poll)
+    else:
+        parser.print_help()
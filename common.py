@@ -0,0 +1,359 @@
+"""Metrics, csv files and manifests, shared by the commands and the raw export of ``registry``.
+
+Nothing here imports peewee or the models, so that a plain hourly export can run without them.
+"""
+import atexit
+import collections
+import contextlib
+import csv
+import datetime
+import errno
+import functools
+import hashlib
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+
+log = logging
+
+
+def _peak_rss():
+    """Peak RSS in bytes of this process and of its largest finished child, None where unknown."""
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+class Metrics(object):
+    """Seconds and rows per table and stage of the running command.
+
+    Stages are query, fetch, convert, write, insert, commit, and the statements of copy, rollup and compact.
+    Child processes send their ``snapshot()`` back to be merged.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.seconds = collections.defaultdict(float)
+        self.rows = collections.Counter()
+
+    def reset(self):
+        self.__init__()
+
+    def add(self, table, stage, seconds, rows=0):
+        self.seconds[table, stage] += seconds
+        self.rows[table, stage] += rows
+
+    @contextlib.contextmanager
+    def timer(self, table, stage, rows=0):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(table, stage, time.perf_counter() - started, rows)
+
+    def timed(self, iterable, table, stage):
+        """Yield from ``iterable``, adding up the time spent getting each item and the items."""
+        clock = time.perf_counter
+        iterator = iter(iterable)
+        seconds = 0.0
+        count = 0
+        try:
+            while True:
+                started = clock()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    seconds += clock() - started
+                    return
+                seconds += clock() - started
+                count += 1
+                yield item
+        finally:
+            self.add(table, stage, seconds, count)
+
+    def timed_call(self, fn, table, stage):
+        """Wrap ``fn`` to add up its time, counting a row per call."""
+        key = (table, stage)
+        clock = time.perf_counter
+        seconds = self.seconds
+        rows = self.rows
+
+        def call(*args):
+            started = clock()
+            result = fn(*args)
+            seconds[key] += clock() - started
+            rows[key] += 1
+            return result
+        return call
+
+    def snapshot(self):
+        return [(table, stage, seconds, self.rows[table, stage]) for (table, stage), seconds in self.seconds.items()]
+
+    def merge(self, snapshot):
+        for table, stage, seconds, rows in snapshot:
+            self.add(table, stage, seconds, rows)
+
+    def summary(self, command):
+        peak, children = _peak_rss()
+        tables = collections.defaultdict(dict)
+        for (table, stage), seconds in sorted(self.seconds.items()):
+            rows = self.rows[table, stage]
+            tables[table][stage] = {'seconds': round(seconds, 6), 'rows': rows,
+                                    'rows_per_sec': round(rows / seconds) if seconds and rows else None}
+        return {
+            'command': command,
+            'started': datetime.datetime.fromtimestamp(self.started).isoformat(),
+            'seconds': round(time.time() - self.started, 6),
+            'peak_rss_bytes': peak,
+            'children_peak_rss_bytes': children,
+            'tables': tables,
+        }
+
+    def prometheus(self, command):
+        """The summary in the Prometheus text format, for the node exporter textfile collector."""
+        summary = self.summary(command)
+        lines = []
+
+        def metric(name, text, samples):
+            lines.append('# HELP tool_{} {}'.format(name, text))
+            lines.append('# TYPE tool_{} gauge'.format(name))
+            for labels, value in samples:
+                lines.append('tool_{}{{{}}} {}'.format(
+                    name, ','.join('{}="{}"'.format(k, v) for k, v in [('command', command)] + labels), value))
+
+        metric('last_run_timestamp_seconds', 'Start of the last run.', [([], self.started)])
+        metric('run_seconds', 'Duration of the last run.', [([], summary['seconds'])])
+        if summary['peak_rss_bytes'] is not None:
+            metric('peak_rss_bytes', 'Peak resident memory of the last run.',
+                   [([('process', 'main')], summary['peak_rss_bytes']),
+                    ([('process', 'children')], summary['children_peak_rss_bytes'])])
+        stages = [([('table', table), ('stage', stage)], values)
+                  for table, table_stages in sorted(summary['tables'].items())
+                  for stage, values in sorted(table_stages.items())]
+        metric('stage_seconds', 'Seconds spent per table and stage.', [(l, v['seconds']) for l, v in stages])
+        metric('stage_rows', 'Rows processed per table and stage.', [(l, v['rows']) for l, v in stages])
+        return '\n'.join(lines) + '\n'
+
+    def save(self, file, command):
+        """Write the summary as json, or in the Prometheus text format for a ``.prom`` file, atomically."""
+        tmp = file + '.tmp'
+        with open(tmp, 'w') as f:
+            if file.endswith('.prom'):
+                f.write(self.prometheus(command))
+            else:
+                json.dump(self.summary(command), f, indent=2, sort_keys=True)
+        os.replace(tmp, file)
+
+
+METRICS = Metrics()
+
+
+def _configure(args):
+    """Set up logging from ``--log``, and write the ``--metrics`` of the run when it exits."""
+    for n in ['peewee', 'PIL', 'Django']:
+        logging.getLogger(n).setLevel(logging.WARN)
+
+    _level = logging.INFO
+    if args.log is not None:
+        _level = logging.getLevelName(args.log.upper())
+
+    logging.basicConfig(level=_level,
+                        format='[%(asctime)s %(levelname)s %(relativeCreated)d %(module)s:%(lineno)d]: %(message)s')
+
+    # Reported at exit, so failed and sys.exit() runs are covered too.
+    if args.metrics is not None:
+        atexit.register(METRICS.save, args.metrics, args.cmd)
+
+
+def _require(module, fmt):
+    """Import the optional ``module`` a format depends on."""
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        raise ImportError('{} format requires the {} package'.format(fmt, module.split('.')[0]))
+
+
+def _open_text(file, mode, fmt='csv'):
+    """Open a csv file for text ``mode``, compressing or decompressing on the fly."""
+    if fmt == 'csv.gz':
+        import gzip
+        return gzip.open(file, mode + 't', newline='')
+    if fmt == 'csv.zst':
+        return _require('zstandard', fmt).open(file, mode + 't', newline='')
+    return open(file, mode, newline='')
+
+
+def _table_file(directory, name, fmt='csv'):
+    return os.path.join(directory, '{}.{}'.format(name, fmt))
+
+
+class CsvWriter(object):
+    """Writes record dicts, or batches of value tuples in ``fieldnames`` order, to a plain, gzip or zstd csv file."""
+
+    def __init__(self, file, model, fieldnames, fmt='csv'):
+        self.name = file
+        self._f = _open_text(file, 'w', fmt)
+        writer = csv.DictWriter(self._f, fieldnames=fieldnames, quoting=csv.QUOTE_MINIMAL)
+        writer.writeheader()
+        self.writerow = writer.writerow
+        self.write_values = csv.writer(self._f, quoting=csv.QUOTE_MINIMAL).writerows
+
+    def flush(self):
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _time_range(date, hour=None):
+    """Half-open ``[start, end)`` window covering a day, or one hour of it.
+
+    Comparing ``time`` against plain bounds lets SQLite use an index on the
+    column instead of evaluating strftime() for every row.
+
+    Args:
+        date: datetime of the day to cover.
+        hour: Optional hour of the day.
+
+    Returns:
+        (start, end) datetimes.
+    """
+    start = datetime.datetime(date.year, date.month, date.day)
+    if hour is None:
+        return start, start + datetime.timedelta(days=1)
+    start = start.replace(hour=hour)
+    return start, start + datetime.timedelta(hours=1)
+
+
+FETCH_SIZE = 10000
+
+
+def _export_raw(execute, file, open_writer, name, table, columns, time_column, date, hour=None):
+    """Export the rows of a day or hour of ``table`` to csv, or all its rows when it has no time column.
+
+    The rows are written straight from the sqlite cursor, ``FETCH_SIZE`` value tuples at a time,
+    without building model instances or dicts.
+
+    Args:
+        execute: Runs SQL with parameters and returns a cursor: ``execute_sql`` of the peewee database,
+            or ``execute`` of a sqlite3 connection.
+        file: Path of the file, or a ``StreamWriter``, for the log.
+        open_writer: Opens the writer of ``file``.
+        name: Name of the model of ``table``, for the log.
+        table: Database table.
+        columns: Select list of the csv columns, from ``commands._raw_columns()``.
+        time_column: Column the day or hour is filtered on, or None.
+        date: datetime of the day to export.
+        hour: Optional hour of the day.
+
+    Returns:
+        Number of rows written.
+    """
+    if time_column is None:
+        log.info('start export from {0}. no time column, all rows'.format(name))
+        where, params = '', []
+    else:
+        log.info('start export from {0}. filter date {1} hour {2}'.format(name, date.date(), hour))
+        start, end = _time_range(date, hour)
+        where, params = ' WHERE "{0}" >= ? AND "{0}" < ?'.format(time_column), [str(start), str(end)]
+
+    log.info('generating {0}'.format(file))
+
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    count = 0
+    with open_writer() as writer:
+        with METRICS.timer(table, 'query'):
+            cursor = execute('SELECT {} FROM "{}"{}'.format(columns, table, where), params)
+        while True:
+            with METRICS.timer(table, 'fetch'):
+                rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            if debug:
+                log.debug('{}: {}'.format(count + 1, rows[0]))
+            with METRICS.timer(table, 'write', len(rows)):
+                writer.write_values(rows)
+            count += len(rows)
+    log.info('{} exported'.format(count))
+    return count
+
+
+def _load_state(file):
+    """Read the watermarks of an incremental export, keyed by table name."""
+    try:
+        with open(file) as f:
+            return json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return {}
+
+
+def _save_state(file, state):
+    """Replace the state file atomically, so an interrupted run keeps the previous watermarks."""
+    tmp = file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp, file)
+
+
+MANIFEST = 'manifest.json'
+# Directory next to db.sqlite3 holding the monthly shards of a sharded layout.
+SHARD_SUFFIX = '.shards'
+
+
+def _checksum(file):
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(functools.partial(f.read, 1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _save_manifest(directory, files, totals):
+    """Write the exported files, their rows, sizes and sha256, and the ``totals`` by table to ``directory/manifest.json``.
+
+    Args:
+        directory: Export directory. File paths are made relative to it.
+        files: Dicts of ``table``, ``file`` and ``rows``, and ``start``/``end`` for partitions.
+        totals: Dict of table name to ``{'exported': rows}``, and the total rows of the table when asked.
+    """
+    _save_state(os.path.join(directory, MANIFEST), {
+        'created': str(datetime.datetime.now()),
+        'tables': totals,
+        'files': [dict(f, file=os.path.relpath(f['file'], directory), bytes=os.path.getsize(f['file']),
+                       sha256=_checksum(f['file'])) for f in files],
+    })
+
+
+def _readonly_uri(path):
+    """SQLite URI opening ``path`` read-only.
+
+    Built by hand: pathlib and urllib take longer to import than most hourly exports take to run.
+    """
+    path = os.path.abspath(path).replace(os.sep, '/')
+    for c in '%?#':
+        path = path.replace(c, '%{:02X}'.format(ord(c)))
+    return 'file:{}{}?mode=ro'.format('' if path.startswith('/') else '/', path)
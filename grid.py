@@ -0,0 +1,182 @@
+"""Dense per-rect and per-floor heatmap grids built from heat and stay values.
+
+Every grid has the shape ``(hours, h, w)``: one ``h`` x ``w`` layer per hour of the window.
+Values are streamed from SQLite in large batches and accumulated with a single
+``numpy.add.at`` per batch into one flat buffer that holds the grids of all rectangles.
+"""
+import datetime
+import logging
+
+import numpy as np
+
+from models import database_proxy, HeatmapHeatvalue, HeatmapStayvalue, ShopRectangle, ShopCamera
+
+log = logging
+
+FETCH_SIZE = 65536
+EPOCH = datetime.datetime(1970, 1, 1)
+
+SOURCES = {
+    'heat': (HeatmapHeatvalue, 'hot'),
+    'stay': (HeatmapStayvalue, 'stay'),
+}
+
+
+def _hours(start, end):
+    return int((end - start).total_seconds() // 3600)
+
+
+def load_rects():
+    """Rectangles by id, as ``(camera_id, x, y, w, h)``."""
+    cursor = database_proxy.execute_sql(
+        'SELECT "id", "camera_id", "x", "y", "w", "h" FROM "{}" WHERE NOT "is_deleted"'.format(
+            ShopRectangle._meta.db_table))
+    return {row[0]: row[1:] for row in cursor}
+
+
+def build_rect_grids(source, start, end, rects=None):
+    """Accumulate the values of ``[start, end)`` into one ``(hours, h, w)`` int64 grid per rectangle.
+
+    Points outside their rectangle, soft deleted points and points of unknown rectangles are skipped.
+
+    Args:
+        source: ``heat`` or ``stay``.
+        start: datetime, start of the window. Hours are counted from it.
+        end: datetime, end of the window.
+        rects: Result of ``load_rects()``, loaded when None.
+
+    Returns:
+        Dict of rect id to grid.
+    """
+    model, value = SOURCES[source]
+    rects = load_rects() if rects is None else rects
+    ids = sorted(rects)
+    codes = {rect_id: code for code, rect_id in enumerate(ids)}
+    hours = _hours(start, end)
+    w = np.array([rects[i][3] for i in ids], dtype=np.int64)
+    h = np.array([rects[i][4] for i in ids], dtype=np.int64)
+    sizes = hours * w * h
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    buffer = np.zeros(int(offsets[-1]), dtype=np.int64)
+
+    cursor = database_proxy.execute_sql(
+        'SELECT "{rect}", "x", "y", (CAST(strftime(\'%s\', "time") AS INTEGER) - ?) / 3600, "{value}" '
+        'FROM "{table}" WHERE "time" >= ? AND "time" < ? AND NOT "is_deleted"'.format(
+            rect=model.rect.db_column, value=value, table=model._meta.db_table),
+        [int((start - EPOCH).total_seconds()), str(start), str(end)])
+    count = 0
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        count += len(rows)
+        rect_ids, x, y, hour, v = zip(*rows)
+        code = np.array([codes.get(r, -1) for r in rect_ids], dtype=np.int64)
+        x = np.array(x, dtype=np.int64)
+        y = np.array(y, dtype=np.int64)
+        hour = np.array(hour, dtype=np.int64)
+        v = np.array(v, dtype=np.int64)
+        known = code >= 0
+        cw = np.where(known, w[code], 0)
+        ch = np.where(known, h[code], 0)
+        keep = known & (x >= 0) & (x < cw) & (y >= 0) & (y < ch) & (hour >= 0) & (hour < hours)
+        code, x, y, hour, v, cw, ch = code[keep], x[keep], y[keep], hour[keep], v[keep], cw[keep], ch[keep]
+        flat = offsets[code] + (hour * ch + y) * cw + x
+        np.add.at(buffer, flat, v)
+    log.info('{} {} values accumulated into {} rect grids'.format(count, source, len(ids)))
+    return {rect_id: buffer[offsets[i]:offsets[i + 1]].reshape(hours, rects[rect_id][4], rects[rect_id][3])
+            for i, rect_id in enumerate(ids)}
+
+
+def join_hours(parts):
+    """Join the grids of consecutive windows, each a result of ``build_rect_grids()``, along their hours."""
+    if len(parts) == 1:
+        return parts[0]
+    return {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+
+
+def load_cameras():
+    """Cameras by id, as ``(floor_id, floor_x, floor_y, ratio)``."""
+    cursor = database_proxy.execute_sql(
+        'SELECT "id", "floor_id", "floor_x", "floor_y", "ratio" FROM "{}" WHERE NOT "is_deleted"'.format(
+            ShopCamera._meta.db_table))
+    return {row[0]: row[1:] for row in cursor}
+
+
+def project_to_floors(grids, rects=None, cameras=None):
+    """Add the rect grids up on the floors of their cameras.
+
+    A cell ``(x, y)`` of a rectangle lands on the floor cell
+    ``(floor_x + (rect.x + x) * ratio, floor_y + (rect.y + y) * ratio)`` of its camera.
+    Each floor grid is just large enough to hold every rectangle projected on it. Cells landing left of
+    or above the floor, as negative ``floor_x``/``floor_y`` can make them, are dropped, and so are
+    rectangles without cells.
+
+    Args:
+        grids: Result of ``build_rect_grids()``.
+        rects: Result of ``load_rects()``, loaded when None.
+        cameras: Result of ``load_cameras()``, loaded when None.
+
+    Returns:
+        Dict of floor id to ``(hours, floor h, floor w)`` grid.
+    """
+    rects = load_rects() if rects is None else rects
+    cameras = load_cameras() if cameras is None else cameras
+    cells = {}
+    for rect_id, grid in grids.items():
+        camera_id, rx, ry, w, h = rects[rect_id]
+        camera = cameras.get(camera_id)
+        if camera is None or camera[0] is None:
+            continue
+        if w <= 0 or h <= 0:
+            continue
+        floor_id, floor_x, floor_y, ratio = camera
+        ys, xs = np.mgrid[0:h, 0:w]
+        fx = np.floor(floor_x + (rx + xs.ravel()) * ratio).astype(np.int64)
+        fy = np.floor(floor_y + (ry + ys.ravel()) * ratio).astype(np.int64)
+        inside = (fx >= 0) & (fy >= 0)
+        if not inside.any():
+            continue
+        cells.setdefault(floor_id, []).append((fx[inside], fy[inside], grid.reshape(grid.shape[0], -1)[:, inside]))
+
+    floors = {}
+    for floor_id, parts in cells.items():
+        hours = parts[0][2].shape[0]
+        # Never empty: the cells kept are on the floor.
+        fw = max(int(max(fx.max() for fx, _, _ in parts)) + 1, 1)
+        fh = max(int(max(fy.max() for _, fy, _ in parts)) + 1, 1)
+        size = fh * fw
+        floor = np.zeros(hours * size, dtype=np.int64)
+        for fx, fy, values in parts:
+            flat = (np.arange(hours)[:, None] * size + fy * fw + fx).ravel()
+            # Summed in int64, as build_rect_grids() does: float64 weights would round large sums.
+            np.add.at(floor, flat, values.ravel())
+        floors[floor_id] = floor.reshape(hours, fh, fw)
+    return floors
+
+
+def to_sparse(grid):
+    """Coordinates ``(hour, y, x)`` and values of the non-zero cells of a grid."""
+    coords = np.nonzero(grid)
+    return np.stack(coords, axis=1).astype(np.int32), grid[coords]
+
+
+def save_grids(file, grids, sparse=False):
+    """Save grids to a ``.npz`` file keyed by id, or a single grid to ``.npy``.
+
+    Sparse grids are stored as ``<id>.coords`` and ``<id>.values`` arrays of their non-zero cells.
+    """
+    if file.endswith('.npy'):
+        if len(grids) != 1:
+            raise ValueError('.npy holds a single grid, got {}'.format(len(grids)))
+        np.save(file, next(iter(grids.values())))
+        return
+    arrays = {}
+    for key, grid in grids.items():
+        if sparse:
+            arrays[key + '.coords'], arrays[key + '.values'] = to_sparse(grid)
+            arrays[key + '.shape'] = np.array(grid.shape, dtype=np.int64)
+        else:
+            arrays[key] = grid
+    with open(file, 'wb') as f:
+        np.savez_compressed(f, **arrays)
@@ -0,0 +1,25 @@
+"""Command names, choices and defaults shared by the command line and the commands.
+
+tool.py builds its parser from these before the commands are imported, keep this module light.
+"""
+import datetime
+import os
+
+CMDS = ['export', 'import', 'index', 'copy', 'rollup', 'grid', 'compact', 'bench', 'shard', 'serve']
+DEFAULT_SQLITE_FILE = 'db.sqlite3'
+
+FORMATS = ['csv', 'csv.gz', 'csv.zst', 'parquet', 'npz']
+COLUMNAR_FORMATS = ['parquet', 'npz']
+PARTITIONS = {
+    'day': (datetime.timedelta(days=1), '%Y-%m-%d'),
+    'hour': (datetime.timedelta(hours=1), os.path.join('%Y-%m-%d', '%H')),
+}
+STATS = ['estimate', 'cached', 'exact']
+ON_CONFLICT = ['ignore', 'replace', 'update-if-newer']
+
+FOLLOW_POLL = 1.0
+FOLLOW_LIMIT = 10000
+FOLLOW_ROTATE = 300
+FOLLOW_LAG = 2.0
+
+COMPACT_BATCH_SIZE = 5000
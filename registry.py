@@ -0,0 +1,120 @@
+"""Column registry of the exported tables, so that a day or hour export runs without peewee or the models.
+
+The registry holds, for each of the default export tables, what the raw csv export reads: its database
+table, csv header, select list and time column. The commands write it from the models to the user's cache
+directory, in a file named by the digest of models.py and commands.py, so a change of either writes a new
+one and installs or checkouts of other versions keep theirs. ``tool.py`` hands the plain
+``export -d DATE [-t HOUR] -o DIR`` runs to ``run_export()``, which reads it with sqlite3 alone.
+"""
+import datetime
+import functools
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+
+from common import SHARD_SUFFIX, CsvWriter, _configure, _table_file, _makedirs, _save_manifest, _readonly_uri, \
+    _export_raw
+from options import CMDS, DEFAULT_SQLITE_FILE
+
+log = logging
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CACHE_NAME = 'heatmap-tool'
+# The registry is built from both: the fields from the models, the select lists by commands._raw_columns().
+SOURCES = ['models.py', 'commands.py']
+CSV_FORMATS = ['csv', 'csv.gz', 'csv.zst']
+
+
+def _digest():
+    digest = hashlib.sha256()
+    for name in SOURCES:
+        with open(os.path.join(HERE, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _cache_dir():
+    """Directory of the registries: under ``%LOCALAPPDATA%`` on Windows, else ``$XDG_CACHE_HOME`` or ``~/.cache``."""
+    base = os.environ.get('LOCALAPPDATA') if os.name == 'nt' else None
+    base = base or os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, CACHE_NAME)
+
+
+def _registry_file():
+    """Path of the registry of the current models.py and commands.py."""
+    return os.path.join(_cache_dir(), 'registry-{}.json'.format(_digest()))
+
+
+def load():
+    """The registry of the current sources, or None when none was written yet."""
+    try:
+        with open(_registry_file()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save(tables):
+    """Write the registry of ``tables`` unless it is up to date.
+
+    Written to a temporary file first and renamed, so concurrent runs each leave a whole registry.
+    Skipped where the cache directory cannot be written: the exports then go through the commands.
+
+    Args:
+        tables: Dicts of ``name``, ``model``, ``table``, ``fieldnames``, ``columns`` and ``time``, in export order.
+    """
+    file = _registry_file()
+    if os.path.exists(file):
+        return
+    tmp = '{}.{}.tmp'.format(file, os.getpid())
+    try:
+        _makedirs(os.path.dirname(file))
+        with open(tmp, 'w') as f:
+            json.dump({'tables': tables}, f, indent=2, sort_keys=True)
+        os.replace(tmp, file)
+    except OSError as e:
+        log.debug('registry not written: {}'.format(e))
+
+
+def run_export(args):
+    """Export a day or hour to csv files from the registry, as ``commands.run()`` does, without peewee.
+
+    Returns:
+        False, having done nothing, when the run needs the commands: other commands or modes, ``--tables``,
+        ``--jobs``, ``--stats``, ``--profile``, columnar formats, streams, sharded databases, or no up to
+        date registry.
+    """
+    if (args.cmd != CMDS[0] or args.date is None or args.output in (None, '-') or args.follow is not None or
+            args.incremental is not None or args.date_from is not None or args.tables is not None or
+            args.jobs > 1 or args.stats is not None or args.profile is not None or args.format not in CSV_FORMATS):
+        return False
+    path = args.sqlite or DEFAULT_SQLITE_FILE
+    if os.path.isdir(path + SHARD_SUFFIX):
+        return False
+    registry = load()
+    if registry is None:
+        return False
+
+    _configure(args)
+    log.info('{} from {}'.format(args.cmd, args.sqlite))
+    date = datetime.datetime.strptime(args.date, '%Y-%m-%d')
+    if args.hour is not None:
+        date = datetime.datetime.strptime('{0} {1}'.format(args.date, args.hour), '%Y-%m-%d %H')
+    connection = sqlite3.connect(_readonly_uri(path), uri=True)
+    try:
+        _makedirs(args.output)
+        files, totals = [], {}
+        for table in registry['tables']:
+            file = _table_file(args.output, table['name'], args.format)
+            count = _export_raw(connection.execute, file,
+                                functools.partial(CsvWriter, file, None, table['fieldnames'], args.format),
+                                table['model'], table['table'], table['columns'], table['time'], date, args.hour)
+            files.append({'table': table['name'], 'file': file, 'rows': count})
+            totals[table['name']] = {'exported': count}
+    finally:
+        connection.close()
+    _save_manifest(args.output, files, totals)
+    return True
+
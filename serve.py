@@ -0,0 +1,365 @@
+"""Local HTTP/JSON server answering hourly range queries on the report tables.
+
+Dashboards ask ``GET /reports/<report>?area=<id>&from=<hour>&to=<hour>&metric=<name>`` and get
+the per-hour sums of the ``[from, to)`` window as json. Queries run on a pool of read-only
+connections in threads, so the event loop keeps serving while SQLite works. Answers are kept in
+an LRU cache: answers about finished hours never expire, the others live for a TTL. A watcher
+notices commits by ``PRAGMA data_version`` and drops the answers covering the hours written since,
+as the touched hours triggers of the report tables record them.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import datetime
+import json
+import logging
+import queue
+import sqlite3
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from peewee import IntegerField
+from commands import HOUR_FORMAT, TOUCHED_HOURS
+from common import _readonly_uri
+from models import FlowFlowreport, PeoplePeoplereport, HeatmapHeatmapreport, HeatmapStaymapreport, \
+    ProductProductreport
+
+log = logging
+
+MAX_HEADER = 16384
+
+Report = collections.namedtuple('Report', ['name', 'model', 'key', 'metrics'])
+
+
+def _report(name, model, key):
+    """Report served for ``model``, grouped by its ``key`` foreign key, with its integer columns as metrics."""
+    return Report(name, model, key, [f.name for f in model._meta.sorted_fields if type(f) is IntegerField])
+
+
+REPORTS = collections.OrderedDict((r.name, r) for r in [
+    _report('flow', FlowFlowreport, 'area'),
+    _report('people', PeoplePeoplereport, 'area'),
+    _report('heatmap', HeatmapHeatmapreport, 'area'),
+    _report('staymap', HeatmapStaymapreport, 'area'),
+    _report('product', ProductProductreport, 'sku'),
+])
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super(HttpError, self).__init__(message)
+        self.status = status
+
+
+class ConnectionPool(object):
+    """Read-only SQLite connections shared by the threads of an executor, one query at a time each."""
+
+    def __init__(self, path, size):
+        self._connections = queue.Queue()
+        for _ in range(size):
+            self._connections.put(sqlite3.connect(_readonly_uri(path), uri=True, check_same_thread=False))
+
+    def execute(self, sql, params=()):
+        """Run a query on a free connection and return all its rows."""
+        conn = self._connections.get()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            self._connections.put(conn)
+
+    def close(self):
+        while not self._connections.empty():
+            self._connections.get().close()
+
+
+Entry = collections.namedtuple('Entry', ['body', 'report', 'start', 'end', 'expires'])
+
+
+class ReportCache(object):
+    """LRU cache of encoded answers, keyed by query.
+
+    Answers about finished hours are pinned: they do not expire, and are only evicted when
+    every other answer is gone. The others expire ``ttl`` seconds after they were computed.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.hits = self.misses = self.invalidated = 0
+        # Bumped by every invalidation, so answers computed across one are not stored.
+        self.generation = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires is not None and entry.expires <= time.monotonic():
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry.body
+
+    def put(self, key, body, report, start, end, pinned):
+        self._entries[key] = Entry(body, report, start, end, None if pinned else time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            victim = next((k for k, e in self._entries.items() if e.expires is not None), None)
+            if victim is None:
+                victim = next(iter(self._entries))
+            del self._entries[victim]
+
+    def invalidate(self, report, hours=None):
+        """Drop the answers of ``report`` covering any of ``hours``, hour strings, or all of them."""
+        self.generation += 1
+        stale = [k for k, e in self._entries.items()
+                 if e.report == report and (hours is None or any(e.start <= h < e.end for h in hours))]
+        for key in stale:
+            del self._entries[key]
+        self.invalidated += len(stale)
+        return len(stale)
+
+    def stats(self):
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                'invalidated': self.invalidated,
+                'pinned': sum(1 for e in self._entries.values() if e.expires is None)}
+
+
+def _parse_hour(text, name, ceil=False):
+    """Hour string of an ISO date or datetime, the next hour for a ``ceil`` of a time within an hour."""
+    try:
+        value = datetime.datetime.fromisoformat(text)
+    except (TypeError, ValueError):
+        raise HttpError(400, '{} must be an ISO date or datetime, got {!r}'.format(name, text))
+    hour = value.replace(minute=0, second=0, microsecond=0)
+    if ceil and hour != value:
+        hour += datetime.timedelta(hours=1)
+    return hour
+
+
+def _query(report, key, start, end, metrics):
+    """SQL and parameters of the per-hour sums of ``metrics`` over ``[start, end)``, for one key or all."""
+    model = report.model
+    hour = model.hour.db_column
+    where, params = '"{}" >= ? AND "{}" < ? AND NOT "is_deleted"'.format(hour, hour), [start, end]
+    if key is not None:
+        where += ' AND "{}" = ?'.format(getattr(model, report.key).db_column)
+        params.append(key)
+    sql = 'SELECT "{hour}", {sums} FROM "{table}" WHERE {where} GROUP BY "{hour}" ORDER BY "{hour}"'.format(
+        hour=hour, sums=', '.join('SUM("{}")'.format(m) for m in metrics), table=model._meta.db_table, where=where)
+    return sql, params
+
+
+class ReportServer(object):
+    """Answer report queries from the cache, or from the pool on a miss.
+
+    Args:
+        path: Path of the sqlite database.
+        connections: Size of the connection pool, and of the thread pool running its queries.
+        cache_size: Most answers kept.
+        ttl: Seconds an answer about the current or future hours is kept.
+        poll: Seconds between checks for written report rows.
+    """
+
+    def __init__(self, path, connections=4, cache_size=10000, ttl=60.0, poll=5.0):
+        self.path = path
+        self.poll = poll
+        self.cache = ReportCache(cache_size, ttl)
+        self.pool = ConnectionPool(path, connections)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=connections)
+        # Misses being computed, so concurrent identical queries share one SQL run.
+        self._pending = {}
+        # Connection of the watcher alone, whose data_version moves when another connection commits.
+        self._watcher = sqlite3.connect(_readonly_uri(path), uri=True, check_same_thread=False)
+        self._version = self._seq = None
+        self._failing = None
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def report(self, name, params):
+        """Encoded json answer of a report query."""
+        report = REPORTS.get(name)
+        if report is None:
+            raise HttpError(404, 'unknown report {!r}, one of {}'.format(name, ', '.join(REPORTS)))
+        unknown = set(params) - {report.key, 'from', 'to', 'metric'}
+        if unknown:
+            raise HttpError(400, 'unknown parameters {}'.format(', '.join(sorted(unknown))))
+        if 'from' not in params or 'to' not in params:
+            raise HttpError(400, 'from and to are required')
+        start = _parse_hour(params['from'], 'from')
+        end = _parse_hour(params['to'], 'to', ceil=True)
+        metrics = params['metric'].split(',') if params.get('metric') else report.metrics
+        wrong = [m for m in metrics if m not in report.metrics]
+        if wrong:
+            raise HttpError(400, 'unknown metrics {}, {} has {}'.format(', '.join(wrong), name,
+                                                                       ', '.join(report.metrics)))
+        key = params.get(report.key)
+        start, end = start.strftime(HOUR_FORMAT), end.strftime(HOUR_FORMAT)
+        cache_key = (name, key, start, end, tuple(metrics))
+        body = self.cache.get(cache_key)
+        if body is not None:
+            return body
+        pending = self._pending.get(cache_key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[cache_key] = future
+        try:
+            generation = self.cache.generation
+            pinned = end <= datetime.datetime.now().strftime(HOUR_FORMAT)
+            rows = await self._run(self.pool.execute, *_query(report, key, start, end, metrics))
+            body = json.dumps({'report': name, report.key: key, 'from': start, 'to': end, 'metrics': metrics,
+                               'hours': [dict(zip(['hour'] + metrics, row)) for row in rows]}).encode()
+            if generation == self.cache.generation:
+                self.cache.put(cache_key, body, name, start, end, pinned)
+            future.set_result(body)
+            return body
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Retrieved, so asyncio does not warn about it when nobody else waited.
+            future.exception()
+            raise
+        finally:
+            del self._pending[cache_key]
+
+    def _written(self):
+        """Hours of each report written since the previous check, None for all of them.
+
+        Reports whose table has no touched hours triggers yet have all their hours written by any commit.
+        """
+        conn = self._watcher
+        version = conn.execute('PRAGMA data_version').fetchone()[0]
+        if version == self._version:
+            return {}
+        tracked = {row[0] for row in conn.execute(
+            'SELECT "tbl_name" FROM sqlite_master WHERE "type" = \'trigger\' AND "name" = "tbl_name" || ?',
+            ['_touched_update'])}
+        seq = None
+        if tracked:
+            seq = conn.execute('SELECT MAX("seq") FROM "{}"'.format(TOUCHED_HOURS)).fetchone()[0] or 0
+        written = {}
+        if self._version is not None:
+            touched = collections.defaultdict(list)
+            if self._seq is not None and seq is not None:
+                for table, hour in conn.execute('SELECT "table", "hour" FROM "{}" WHERE "seq" > ? AND "seq" <= ?'.format(
+                        TOUCHED_HOURS), [self._seq, seq]):
+                    touched[table].append(hour)
+            for report in REPORTS.values():
+                table = report.model._meta.db_table
+                # Hours written before the triggers came are not known.
+                written[report.name] = touched[table] if table in tracked and self._seq is not None else None
+        self._version, self._seq = version, seq
+        return written
+
+    async def watch(self):
+        """Invalidate the answers covering the hours written since the last check, every ``poll`` seconds."""
+        while True:
+            try:
+                written = await self._run(self._written)
+            except sqlite3.Error as e:
+                if self._failing != str(e):
+                    log.warning('cannot check for written hours: {}'.format(e))
+                self._failing = str(e)
+                written = {}
+            else:
+                self._failing = None
+            for name, hours in written.items():
+                if hours is None:
+                    count = self.cache.invalidate(name)
+                    log.info('{}: written, {} answers dropped'.format(name, count))
+                elif hours:
+                    count = self.cache.invalidate(name, hours)
+                    log.info('{}: {} hours written, {} answers dropped'.format(name, len(hours), count))
+            await asyncio.sleep(self.poll)
+
+    async def respond(self, method, target):
+        """Status and encoded json body of a request."""
+        if method != 'GET':
+            raise HttpError(405, 'only GET is supported')
+        url = urlsplit(target)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        parts = [p for p in url.path.split('/') if p]
+        if parts == ['reports']:
+            return 200, json.dumps({r.name: {'key': r.key, 'metrics': r.metrics} for r in REPORTS.values()}).encode()
+        if len(parts) == 2 and parts[0] == 'reports':
+            return 200, await self.report(parts[1], params)
+        if parts == ['stats']:
+            return 200, json.dumps(self.cache.stats()).encode()
+        raise HttpError(404, 'no such path {}'.format(url.path))
+
+    async def handle(self, reader, writer):
+        """Serve the requests of one connection, kept alive until the client closes it or asks to."""
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except asyncio.IncompleteReadError:
+                    break
+                except asyncio.LimitOverrunError:
+                    await self._send(writer, 431, b'{"error": "request header too large"}', False)
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                request = lines[0].split()
+                headers = {k.strip().lower(): v.strip() for k, _, v in (line.partition(':') for line in lines[1:] if line)}
+                keep_alive = len(request) == 3 and request[2] == 'HTTP/1.1' and \
+                    headers.get('connection', '').lower() != 'close'
+                started = time.perf_counter()
+                try:
+                    if len(request) != 3:
+                        raise HttpError(400, 'malformed request line')
+                    status, body = await self.respond(request[0], request[1])
+                except HttpError as e:
+                    status, body = e.status, json.dumps({'error': str(e)}).encode()
+                except sqlite3.Error as e:
+                    log.error('{}: {}'.format(request[1], e))
+                    status, body = 500, json.dumps({'error': str(e)}).encode()
+                log.debug('{} {} {:.1f} ms'.format(' '.join(request[:2]), status, (time.perf_counter() - started) * 1e3))
+                await self._send(writer, status, body, keep_alive)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _send(writer, status, body, keep_alive):
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                   431: 'Request Header Fields Too Large', 500: 'Internal Server Error'}
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                     'Connection: {}\r\n\r\n'.format(status, reasons[status], len(body),
+                                                     'keep-alive' if keep_alive else 'close').encode('latin-1'))
+        writer.write(body)
+        await writer.drain()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_HEADER)
+        watcher = asyncio.ensure_future(self.watch())
+        log.info('serving {} on http://{}:{}'.format(self.path, host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+
+    def close(self):
+        self.executor.shutdown()
+        self.pool.close()
+        self._watcher.close()
+
+
+def serve(path, host='127.0.0.1', port=8000, connections=4, cache_size=10000, ttl=60.0, poll=5.0):
+    """Serve the report queries of the database at ``path`` until interrupted."""
+    server = ReportServer(path, connections, cache_size, ttl, poll)
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        log.info('stopped, cache {}'.format(server.cache.stats()))
+    finally:
+        server.close()
@@ -0,0 +1,41 @@
+"""Fixtures of the tests: synthetic databases written by ``bench.generate()``, and ``tool.py`` run as cron runs it."""
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOOL = os.path.join(ROOT, 'tool.py')
+sys.path.insert(0, ROOT)
+
+import bench  # noqa: E402
+
+# Days of bench.START on that the generated database spans: 14 months, more shards than SQLite attaches at once.
+MONTHS_DAYS = 420
+
+
+def run_tool(*argv, stdin=None):
+    """Run ``tool.py argv`` in a process of its own, fed ``stdin`` bytes, and return its stdout.
+
+    Fails the test when it exits non-zero.
+    """
+    return subprocess.run([sys.executable, TOOL, '-l', 'warning'] + [str(a) for a in argv], check=True,
+                          input=stdin, stdout=subprocess.PIPE).stdout
+
+
+@pytest.fixture(scope='session')
+def months_database(tmp_path_factory):
+    """A generated database spanning ``MONTHS_DAYS`` days, not to be written to."""
+    path = str(tmp_path_factory.mktemp('generated') / 'months.sqlite3')
+    bench.generate(path, rows=3000, areas=4, rects=20, days=MONTHS_DAYS)
+    return path
+
+
+@pytest.fixture
+def database(months_database, tmp_path):
+    """A copy of ``months_database`` of the test's own."""
+    path = str(tmp_path / 'db.sqlite3')
+    shutil.copyfile(months_database, path)
+    return path
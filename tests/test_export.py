@@ -0,0 +1,39 @@
+"""Exports of the raw value tables."""
+import csv
+import os
+import subprocess
+
+import pytest
+
+from conftest import run_tool
+
+# The csv columns the value tables have always been exported with, which readers may rely on by position.
+HEADERS = {
+    'heatmap': ['id', 'rect', 'x', 'y', 'time', 'hot', 'created', 'updated', 'is_deleted', 'deleted_time'],
+    'staymap': ['id', 'rect', 'x', 'y', 'time', 'stay', 'created', 'updated', 'is_deleted', 'deleted_time'],
+    'flow': ['id', 'area', 'time', 'flow_in', 'flow_out', 'created', 'updated', 'is_deleted', 'deleted_time'],
+    'people': ['id', 'area', 'time', 'age', 'gender', 'created', 'updated', 'is_deleted', 'deleted_time'],
+}
+
+
+def test_csv_columns(database, tmp_path):
+    run_tool('export', '--sqlite', database, '-d', '2017-12-01', '-o', tmp_path)
+    for name, header in HEADERS.items():
+        with open(os.path.join(tmp_path, name + '.csv'), newline='') as f:
+            rows = list(csv.reader(f))
+        assert rows[0] == header
+        assert len(rows) > 1
+
+
+@pytest.mark.parametrize('argv', [
+    [],
+    ['-d', '2017-12-01', '--from', '2017-12-01'],
+    ['--incremental', 'state.json', '-d', '2017-12-01'],
+    ['--from', '2017-12-01', '-t', '3'],
+    ['-d', '2017-12-01', '--to', '2017-12-02'],
+])
+def test_window_usage_errors(database, tmp_path, argv):
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        run_tool('export', '--sqlite', database, '-o', tmp_path / 'out', *argv)
+    assert e.value.returncode == 2
+    assert not os.path.exists(tmp_path / 'out')
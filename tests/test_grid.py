@@ -0,0 +1,21 @@
+"""Projection of rect grids onto floors."""
+import numpy as np
+
+import grid
+
+
+def test_project_to_floors():
+    # rect id: (camera, x, y, w, h); camera id: (floor, floor_x, floor_y, ratio).
+    rects = {'a': ('c1', 0, 0, 2, 1), 'empty': ('c1', 0, 0, 0, 3), 'left': ('c2', 0, 0, 2, 2),
+             'off': ('c2', 0, 0, 1, 1)}
+    cameras = {'c1': ('f1', 1, 0, 1), 'c2': ('f2', -1, -1, 1)}
+    large = 2 ** 53 + 1
+    grids = {'a': np.array([[[large, 1]], [[2, 3]]], dtype=np.int64),
+             'empty': np.zeros((2, 3, 0), dtype=np.int64),
+             'left': np.array([[[1, 2], [3, 4]], [[5, 6], [7, 8]]], dtype=np.int64),
+             'off': np.array([[[9]], [[9]]], dtype=np.int64)}
+    floors = grid.project_to_floors(grids, rects, cameras)
+    np.testing.assert_array_equal(floors['f1'], [[[0, large, 1]], [[0, 2, 3]]])
+    assert floors['f1'].dtype == np.int64
+    # Shifted up and left by one: only the bottom right cell is on the floor.
+    np.testing.assert_array_equal(floors['f2'], [[[4]], [[8]]])
@@ -0,0 +1,59 @@
+"""Cached answers of serve dropped when their report rows are written, whatever ``updated`` they are given."""
+import asyncio
+import datetime
+import json
+import sqlite3
+
+import bench
+import serve
+from conftest import MONTHS_DAYS, run_tool
+
+FIRST = bench.START.strftime('%Y-%m-%d')
+LAST = (bench.START + datetime.timedelta(days=MONTHS_DAYS - 1)).strftime('%Y-%m-%d')
+
+
+def _hours(path):
+    """The first two days holding flow reports, as ``from`` and ``to`` parameters of a query."""
+    conn = sqlite3.connect(path)
+    try:
+        days = [row[0] for row in conn.execute(
+            'SELECT DISTINCT date("hour_id") FROM "flow_flowreport" ORDER BY 1 LIMIT 2')]
+    finally:
+        conn.close()
+    return [{'from': day, 'to': (datetime.date.fromisoformat(day) + datetime.timedelta(days=1)).isoformat()}
+            for day in days]
+
+
+def _flow_in(body):
+    return sum(hour['flow_in'] for hour in json.loads(body)['hours'])
+
+
+def test_written_hours_dropped(database):
+    run_tool('rollup', '--sqlite', database, '--from', FIRST, '--to', LAST)
+    written, kept = _hours(database)
+    server = serve.ReportServer(database, connections=1, poll=0.01)
+
+    async def scenario():
+        watcher = asyncio.ensure_future(server.watch())
+        try:
+            await asyncio.sleep(0.1)
+            before = _flow_in(await server.report('flow', written))
+            await server.report('flow', kept)
+            # As an import would: the rows keep the updated values they had.
+            conn = sqlite3.connect(database)
+            with conn:
+                changed = conn.execute('UPDATE "flow_flowreport" SET "flow_in" = "flow_in" + 1000 '
+                                       'WHERE date("hour_id") = ?', [written['from']]).rowcount
+            conn.close()
+            await asyncio.sleep(0.1)
+            assert _flow_in(await server.report('flow', written)) == before + 1000 * changed
+            hits = server.cache.hits
+            await server.report('flow', kept)
+            assert server.cache.hits == hits + 1
+        finally:
+            watcher.cancel()
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        server.close()
@@ -0,0 +1,86 @@
+"""Windows of a sharded database spanning more monthly shards than SQLite attaches at once."""
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+
+import numpy as np
+import pytest
+
+import bench
+from conftest import MONTHS_DAYS, run_tool
+
+FIRST = bench.START.strftime('%Y-%m-%d')
+LAST = (bench.START + datetime.timedelta(days=MONTHS_DAYS - 1)).strftime('%Y-%m-%d')
+
+
+@pytest.fixture
+def sharded(months_database, tmp_path):
+    path = str(tmp_path / 'sharded.sqlite3')
+    shutil.copyfile(months_database, path)
+    run_tool('shard', '--sqlite', path)
+    assert len(os.listdir(path + '.shards')) > 10
+    return path
+
+
+def _files(folder):
+    """Contents of the files of an export folder by relative path, the manifest aside."""
+    files = {}
+    for root, _, names in os.walk(folder):
+        for name in names:
+            if name != 'manifest.json':
+                with open(os.path.join(root, name), 'rb') as f:
+                    files[os.path.relpath(os.path.join(root, name), folder)] = f.read()
+    return files
+
+
+def _manifest_files(folder):
+    with open(os.path.join(folder, 'manifest.json')) as f:
+        return json.load(f)['files']
+
+
+def _rows(path, table):
+    conn = sqlite3.connect(path)
+    try:
+        return sorted(conn.execute('SELECT * FROM "{}"'.format(table)))
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_export_range(database, sharded, tmp_path, jobs):
+    for path, name in [(database, 'plain'), (sharded, 'sharded')]:
+        run_tool('export', '--sqlite', path, '--from', FIRST, '--to', LAST, '-j', jobs, '-o', tmp_path / name)
+    plain = _files(tmp_path / 'plain')
+    assert len(plain) > 4 * 400
+    assert _files(tmp_path / 'sharded') == plain
+    assert _manifest_files(tmp_path / 'sharded') == _manifest_files(tmp_path / 'plain')
+
+
+def test_export_range_stream(database, sharded):
+    plain = run_tool('export', '--sqlite', database, '--from', FIRST, '--to', LAST, '-o', '-')
+    assert run_tool('export', '--sqlite', sharded, '--from', FIRST, '--to', LAST, '-o', '-') == plain
+
+
+def test_copy(database, sharded, tmp_path):
+    targets = []
+    for path, name in [(database, 'plain'), (sharded, 'sharded')]:
+        target = str(tmp_path / (name + '-copy.sqlite3'))
+        bench.create_schema(target)
+        run_tool('copy', '--sqlite', path, '--target', target, '--from', FIRST, '--to', LAST)
+        targets.append(target)
+    for table in ['heatmap_heatvalue', 'heatmap_stayvalue', 'flow_flow', 'people_person']:
+        copied = _rows(targets[1], table)
+        assert copied and copied == _rows(targets[0], table)
+        assert copied == _rows(database, table)
+
+
+def test_grid(database, sharded, tmp_path):
+    for path, name in [(database, 'plain'), (sharded, 'sharded')]:
+        run_tool('grid', '--sqlite', path, '--from', FIRST, '--to', LAST, '-o', tmp_path / (name + '.npz'))
+    plain, sharded_grids = np.load(tmp_path / 'plain.npz'), np.load(tmp_path / 'sharded.npz')
+    assert sorted(sharded_grids.files) == sorted(plain.files)
+    assert sum(int(plain[key].sum()) for key in plain.files) > 0
+    for key in plain.files:
+        np.testing.assert_array_equal(sharded_grids[key], plain[key])
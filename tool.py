@@ -1,215 +1,204 @@
-#!/usr/bin/env python3
-import csv
-import logging
-import argparse
-import json
-import os
-import errno
-import datetime
-from peewee import SqliteDatabase
-from models import database_proxy, HeatmapHeatvalue, HeatmapStayvalue, FlowFlow, PeoplePerson
-
-log = logging
-
-
-class DateTimeEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime.datetime):
-            return obj.isoformat()
-        elif isinstance(obj, datetime.date):
-            return obj.isoformat()
-        elif isinstance(obj, datetime.timedelta):
-            return (datetime.datetime.min + obj).time().isoformat()
-        else:
-            return super(DateTimeEncoder, self).default(obj)
-
-
-def _export_csv(file, model, fields, date, hour=None):
-    """
-
-    Args:
-        file:
-        model:
-        fields:
-        date:
-        hour:
-
-    Returns:
-
-    """
-    log.info('start export from {0}. filter date {1} hour {2}'.format(model.__name__, date.date(), hour))
-    if hour is None:
-        query = model.select().where((model.time.year == date.year) &
-                                     (model.time.month == date.month) &
-                                     (model.time.day == date.day)).dicts()
-    else:
-        query = model.select().where((model.time.year == date.year) &
-                                     (model.time.month == date.month) &
-                                     (model.time.day == date.day) &
-                                     (model.time.hour == hour)).dicts()
-
-    log.info('generating {0}'.format(file))
-
-    with open(file, 'w', newline='') as f:
-        writer = csv.DictWriter(f, fieldnames=fields, quoting=csv.QUOTE_MINIMAL)
-        writer.writeheader()
-        count = 0
-        for record in query:
-            count += 1
-            if count % 1000 == 1:
-                log.debug('{}: {}'.format(count, json.dumps(record, cls=DateTimeEncoder)[0:120]))
-            writer.writerow(record)
-    log.info('{} exported. Total {} records in the table'.format(count, model.select().count()))
-
-
-def _export_heat_map(file, date, hour=None):
-    fieldnames = ['id', 'rect', 'x', 'y', 'time', 'hot', 'created', 'updated', 'is_deleted', 'deleted_time']
-    _export_csv(file, HeatmapHeatvalue, fieldnames, date, hour=hour)
-
-
-def _export_stay_map(file, date, hour=None):
-    fieldnames = ['id', 'rect', 'x', 'y', 'time', 'stay', 'created', 'updated', 'is_deleted', 'deleted_time']
-    _export_csv(file, HeatmapStayvalue, fieldnames, date, hour=hour)
-
-
-def _export_flow(file, date, hour=None):
-    # FlowFlow
-    fieldnames = ['id', 'area', 'time', 'flow_in', 'flow_out', 'created', 'updated', 'is_deleted', 'deleted_time']
-    _export_csv(file, FlowFlow, fieldnames, date, hour=hour)
-
-
-def _export_people(file, date, hour=None):
-    fieldnames = ['id', 'area', 'time', 'age', 'gender', 'created', 'updated', 'is_deleted', 'deleted_time']
-    _export_csv(file, PeoplePerson, fieldnames, date, hour=hour)
-
-
-def _export(directory, date, hour=None):
-    try:
-        os.makedirs(directory)
-    except OSError as e:
-        if e.errno != errno.EEXIST:
-            raise
-    _export_heat_map(os.path.join(directory, 'heatmap.csv'), date, hour)
-    _export_stay_map(os.path.join(directory, 'staymap.csv'), date, hour)
-    _export_flow(os.path.join(directory, 'flow.csv'), date, hour)
-    _export_people(os.path.join(directory, 'people.csv'), date, hour)
-
-
-def _import_csv(file, model, bulk_number=100, typed_fileds=None):
-    log.info('reading {}'.format(file))
-    rows = []
-    with open(file, newline='') as f:
-        reader = csv.DictReader(f)
-        count = 0
-        for row in reader:
-            count += 1
-            for key in ['time', 'updated', 'created', 'deleted_time']:
-                date_string = row.get(key, '')
-                try:
-                    if date_string is None or len(date_string) == 0:
-                        row[key] = None
-                    else:
-                        dt = datetime.datetime.strptime(date_string, "%Y-%m-%d %H:%M:%S.%f")
-                        row[key] = dt
-                except ValueError:
-                    row[key] = None
-            for key in ['is_deleted']:
-                b_string = row.get(key, None)
-                if b_string is not None:
-                    row[key] = (b_string == 'True')
-            if typed_fileds is not None:
-                for t, fields in typed_fileds.items():
-                    for key in fields:
-                        s = row.get(key, None)
-                        if s is not None:
-                            row[key] = t(s)
-
-            if count % 1000 == 1:
-                log.debug('{}: {} {}'.format(count, row['id'], row['time']))
-            rows.append(row)
-
-    with database_proxy.atomic():
-        for idx in range(0, len(rows), bulk_number):
-            model.insert_many(rows[idx:idx + bulk_number]).execute()
-
-    log.info('{} done'.format(count))
-
-
-def _import_heat_map(file, bulk_number=100):
-    _import_csv(file, HeatmapHeatvalue, bulk_number, typed_fileds={int: {'x', 'y', 'hot'}})
-
-
-def _import_stay_map(file, bulk_number=100):
-    _import_csv(file, HeatmapStayvalue, bulk_number, typed_fileds={int: {'x', 'y', 'stay'}})
-
-
-def _import_flow(file, bulk_number=100):
-    _import_csv(file, FlowFlow, bulk_number, typed_fileds={int: {'flow_in', 'flow_out'}})
-
-
-def _import_people(file, bulk_number=100):
-    _import_csv(file, PeoplePerson, bulk_number, typed_fileds={int: {'age', 'gender'}})
-
-
-def _import(folder, bulk_number=100):
-    _import_heat_map(os.path.join(folder, 'heatmap.csv'), bulk_number)
-    _import_stay_map(os.path.join(folder, 'staymap.csv'), bulk_number)
-    _import_flow(os.path.join(folder, 'flow.csv'), bulk_number)
-    _import_people(os.path.join(folder, 'people.csv'), bulk_number)
-
-
-if __name__ == '__main__':
-
-    for n in ['peewee', 'PIL', 'Django']:
-        logging.getLogger(n).setLevel(logging.WARN)
-
-    CMDS = ['export', 'import']
-    DEFAULT_SQLITE_FILE = 'db.sqlite3'
-    parser = argparse.ArgumentParser(description='Help you manage django managed database.')
-    parser.add_argument('-l', '--log', help='Log level', metavar='level')
-
-    subparsers = parser.add_subparsers(help='Actions', dest='cmd', metavar='COMMAND')
-    parser_in = subparsers.add_parser('import', help='Import csv to databse.')
-    parser_ex = subparsers.add_parser('export', help='Export reports in databse to csv')
-
-    parser_ex.add_argument('-o', '--output', help='Path to output csv files', metavar='path', default='.')
-    parser_ex.add_argument('-d', '--date', help='Date to export.', required=True)
-    parser_ex.add_argument('-t', '--hour', help='Optional. Hour to export.', type=int)
-    parser_ex.add_argument('--sqlite', help='Path to sqlite database. Default is db.sqlite3', metavar='database')
-
-    parser_in.add_argument('-i', '--input', help='Path to import csv files', metavar='path', default='.')
-    parser_in.add_argument('-b', '--bulk', help='Bulk number to insert data.', metavar='number')
-    parser_in.add_argument('--sqlite', help='Path to sqlite database. Default is db.sqlite3', metavar='database')
-
-    args = parser.parse_args()
-    _level = logging.INFO
-    if args.log is not None:
-        _level = logging.getLevelName(args.log.upper())
-
-    logging.basicConfig(level=_level,
-                        format='[%(asctime)s %(levelname)s %(relativeCreated)d %(module)s:%(lineno)d]: %(message)s')
-
-    if args.cmd == CMDS[0]:
-
-        if args.date is not None and args.output is not None:
-            database = SqliteDatabase(args.sqlite or DEFAULT_SQLITE_FILE, **{})
-            log.info('{} from {}'.format(args.cmd, args.sqlite))
-            database_proxy.initialize(database)
-            if args.hour is not None:
-                d = datetime.datetime.strptime('{0} {1}'.format(args.date, args.hour), '%Y-%m-%d %H')
-                _export(args.output, d, args.hour)
-            else:
-                d = datetime.datetime.strptime(args.date, '%Y-%m-%d')
-                _export(args.output, d)
-        else:
-            parser.print_help()
-    elif args.cmd == CMDS[1]:
-        if args.input is not None:
-            database = SqliteDatabase(args.sqlite or DEFAULT_SQLITE_FILE, **{})
-            log.info('{} to {}'.format(args.cmd, args.sqlite))
-            database_proxy.initialize(database)
-            _import(args.input)
-        else:
-            parser.print_help()
-    else:
-        parser.print_help()
+#!/usr/bin/env python3
+"""Command line of the tool.
+
+Only argparse is loaded to parse the arguments, so ``-h`` and usage errors return at once. A plain
+day or hour export to csv files then runs from the column registry of ``registry.py``, without peewee.
+Other runs import peewee, the models and the commands, from modules whose bytecode Python caches,
+where a script is compiled again on every run.
+"""
+import argparse
+
+from options import FORMATS, PARTITIONS, STATS, ON_CONFLICT, FOLLOW_POLL, FOLLOW_LIMIT, FOLLOW_ROTATE, \
+    FOLLOW_LAG, COMPACT_BATCH_SIZE
+
+
+def _parser():
+    parser = argparse.ArgumentParser(description='Help you manage django managed database.')
+    parser.add_argument('-l', '--log', help='Log level', metavar='level')
+    parser.add_argument('--metrics', help='Write timings, row counts and peak memory per table and stage to this '
+                                          'file when done. Prometheus text format for .prom, json otherwise',
+                        metavar='file')
+    parser.add_argument('--profile', help='Profile the run with cProfile (cpu) or tracemalloc (memory) and print '
+                                          'the top entries to stderr', choices=['cpu', 'memory'])
+    parser.add_argument('--profile-output', help='Also save the cProfile stats or the tracemalloc snapshot here',
+                        metavar='file')
+
+    subparsers = parser.add_subparsers(help='Actions', dest='cmd', metavar='COMMAND')
+    parser_in = subparsers.add_parser('import', help='Import csv to databse.')
+    parser_ex = subparsers.add_parser('export', help='Export reports in databse to csv')
+    parser_ix = subparsers.add_parser('index', help='Check or create indexes used by export.')
+    parser_cp = subparsers.add_parser('copy', help='Copy reports between databases without csv files.')
+    parser_ru = subparsers.add_parser('rollup', help='Aggregate raw values into the hourly report tables.')
+    parser_gr = subparsers.add_parser('grid', help='Build per-hour heatmap grids as numpy arrays.')
+    parser_cm = subparsers.add_parser('compact', help='Delete or archive old heat and stay values, then vacuum.')
+    parser_bn = subparsers.add_parser('bench', help='Benchmark the commands on a synthetic database.')
+    parser_sh = subparsers.add_parser('shard', help='Move the raw values into monthly database files.')
+    parser_sv = subparsers.add_parser('serve', help='Answer report queries over HTTP/JSON from a cache.')
+
+    parser_ex.add_argument('--tables', help='Tables to export, by short name (heatmap, staymap, flow, people) or database name (shop_camera, '
+                                'product_skuclick, ...), or all. Default is the four value tables', metavar='table', nargs='+')
+    parser_ex.add_argument('-o', '--output', help='Path to output csv files, - to stream to stdout', metavar='path', default='.')
+    # What to export: a day or hour, a range, the changes, or the rows as they arrive.
+    export_mode = parser_ex.add_mutually_exclusive_group(required=True)
+    export_mode.add_argument('-d', '--date', help='Date to export.')
+    export_mode.add_argument('--from', help='First date of a range to export, instead of --date.', dest='date_from',
+                             metavar='DATE')
+    export_mode.add_argument('--incremental', help='Export rows changed since the watermarks saved in this file.',
+                             metavar='state')
+    export_mode.add_argument('--follow', help='Keep exporting the rows past the (time, id) cursors saved in this file '
+                                              'as they arrive, until interrupted. Writes rotating folders in the '
+                                              'output path, or a stream with -o -', metavar='file')
+    parser_ex.add_argument('-t', '--hour', help='Optional. Hour of --date to export.', type=int)
+    parser_ex.add_argument('--to', help='Last date of the range. Default is --from', dest='date_to', metavar='DATE')
+    parser_ex.add_argument('--poll', help='With --follow, seconds between polls once caught up. Default is {}'.format(
+        FOLLOW_POLL), metavar='seconds', type=float, default=FOLLOW_POLL)
+    parser_ex.add_argument('--limit', help='With --follow, most rows read from a table at a time. Default is {}'.format(
+        FOLLOW_LIMIT), metavar='N', type=int, default=FOLLOW_LIMIT)
+    parser_ex.add_argument('--rotate', help='With --follow, seconds of rows in each output folder. Default is {}'.format(
+        FOLLOW_ROTATE), metavar='seconds', type=float, default=FOLLOW_ROTATE)
+    parser_ex.add_argument('--lag', help='With --follow, seconds a row must be old before it is read, so that rows '
+                                         'committed together are read together. Default is {}'.format(FOLLOW_LAG),
+                           metavar='seconds', type=float, default=FOLLOW_LAG)
+    parser_ex.add_argument('--partition', help='Split a range into day or hour folders. Default is day',
+                           choices=sorted(PARTITIONS), default='day')
+    parser_ex.add_argument('--sqlite', help='Path to sqlite database. Default is db.sqlite3', metavar='database')
+    parser_ex.add_argument('-f', '--format', help='File format. columnar is parquet when pyarrow is installed, '
+                                                 'npz otherwise. Default is csv', choices=FORMATS + ['columnar'],
+                           default='csv')
+    parser_ex.add_argument('--stats', help='Add the total rows of each table to the manifest: an estimate from the '
+                                           'last ANALYZE, the counts kept by import, copy, rollup and compact, '
+                                           'or an exact count', choices=STATS)
+    parser_ex.add_argument('-j', '--jobs', help='Tables to export at the same time. Default is 1', metavar='N',
+                           type=int, default=1)
+
+    parser_in.add_argument('--tables', help='Tables to import, by short name (heatmap, staymap, flow, people) or database name (shop_camera, '
+                                'product_skuclick, ...), or all. Default is the four value tables', metavar='table', nargs='+')
+    parser_in.add_argument('-i', '--input', help='Path to import csv files, - to read a stream from stdin', metavar='path', default='.')
+    parser_in.add_argument('-b', '--bulk', help='Bulk number to insert data. Default is 100', metavar='number',
+                           type=int, default=100)
+    parser_in.add_argument('--sqlite', help='Path to sqlite database. Default is db.sqlite3', metavar='database')
+    parser_in.add_argument('--on-conflict', help='Ignore, replace or update-if-newer rows whose id exists. '
+                                                 'Default is to fail', choices=ON_CONFLICT)
+    parser_in.add_argument('-f', '--format', help='File format. Default is found from the files in the input path',
+                           choices=FORMATS + ['columnar'])
+    parser_in.add_argument('--fast-load', help='Use WAL, a large cache and relaxed syncing during the import, '
+                                               'then restore the settings and ANALYZE', action='store_true')
+    parser_in.add_argument('--drop-indexes', help='With --fast-load, rebuild secondary indexes after the import',
+                           action='store_true')
+    parser_in.add_argument('--checkpoint', help='Commit every N rows and resume from the last commit when run again. '
+                                                'Files already imported are skipped', metavar='N', type=int)
+    parser_in.add_argument('-j', '--jobs', help='Csv files to parse at the same time. Default is 1', metavar='N',
+                           type=int, default=1)
+
+    parser_ix.add_argument('--create', help='Create missing indexes.', action='store_true')
+    parser_ix.add_argument('--sqlite', help='Path to sqlite database. Default is db.sqlite3', metavar='database')
+
+    parser_cp.add_argument('--sqlite', help='Path to sqlite database to copy from. Default is db.sqlite3',
+                           metavar='database')
+    parser_cp.add_argument('--target', help='Path to sqlite database to copy to.', metavar='database', required=True)
+    parser_cp.add_argument('-d', '--date', help='Date to copy.')
+    parser_cp.add_argument('-t', '--hour', help='Optional. Hour to copy.', type=int)
+    parser_cp.add_argument('--from', help='First date of a range to copy, instead of --date.', dest='date_from',
+                           metavar='DATE')
+    parser_cp.add_argument('--to', help='Last date of the range. Default is --from', dest='date_to', metavar='DATE')
+    parser_cp.add_argument('--incremental', help='Copy rows changed since the watermarks saved in this file.',
+                           metavar='state')
+    parser_cp.add_argument('--fast-load', help='Use WAL, a large cache and relaxed syncing during the copy, '
+                                               'then restore the settings and ANALYZE', action='store_true')
+    parser_cp.add_argument('--drop-indexes', help='With --fast-load, rebuild secondary indexes after the copy',
+                           action='store_true')
+    parser_cp.add_argument('--on-conflict', help='Ignore, replace or update-if-newer rows whose id exists. '
+                                                 'Default is to fail', choices=ON_CONFLICT)
+
+    parser_ru.add_argument('--sqlite', help='Path to sqlite database. Default is db.sqlite3', metavar='database')
+    parser_ru.add_argument('-d', '--date', help='Date to roll up.')
+    parser_ru.add_argument('-t', '--hour', help='Optional. Hour to roll up.', type=int)
+    parser_ru.add_argument('--from', help='First date of a range to roll up, instead of --date.', dest='date_from',
+                           metavar='DATE')
+    parser_ru.add_argument('--to', help='Last date of the range. Default is --from', dest='date_to', metavar='DATE')
+    parser_ru.add_argument('--incremental', help='Roll up the hours changed since the run that saved this file.',
+                           metavar='state')
+
+    parser_gr.add_argument('--sqlite', help='Path to sqlite database. Default is db.sqlite3', metavar='database')
+    parser_gr.add_argument('-o', '--output', help='.npz file with a grid per id, or .npy for a single grid',
+                           metavar='file', required=True)
+    parser_gr.add_argument('-d', '--date', help='Date to build grids for.')
+    parser_gr.add_argument('-t', '--hour', help='Optional. Hour to build grids for.', type=int)
+    parser_gr.add_argument('--from', help='First date of a range, instead of --date.', dest='date_from',
+                           metavar='DATE')
+    parser_gr.add_argument('--to', help='Last date of the range. Default is --from', dest='date_to', metavar='DATE')
+    parser_gr.add_argument('--value', help='Values to accumulate. Default is heat', choices=['heat', 'stay'],
+                           default='heat')
+    parser_gr.add_argument('--floor', help='Project the rect grids onto their floors', action='store_true')
+    parser_gr.add_argument('--sparse', help='Save only the non-zero cells', action='store_true')
+
+    parser_cm.add_argument('--sqlite', help='Path to sqlite database. Default is db.sqlite3', metavar='database')
+    parser_cm.add_argument('--older-than', help='Remove values from before this many days ago, counted from midnight.',
+                           metavar='days', type=int, required=True)
+    parser_cm.add_argument('--archive', help='Write the removed values to a new folder in this path, in any '
+                                               'format but npz.', metavar='path')
+    parser_cm.add_argument('-f', '--format', help='Archive file format. Default is csv.gz',
+                           choices=FORMATS + ['columnar'], default='csv.gz')
+    parser_cm.add_argument('--check-reports', help='Keep the values of hours that have no report rows yet.',
+                           action='store_true')
+    parser_cm.add_argument('-b', '--batch', help='Rows deleted per transaction. Default is {}'.format(
+        COMPACT_BATCH_SIZE), metavar='N', type=int, default=COMPACT_BATCH_SIZE)
+    parser_cm.add_argument('--enable-auto-vacuum', help='Switch the database to incremental auto_vacuum. '
+                                                        'Rewrites the whole file once', action='store_true')
+
+    parser_bn.add_argument('--rows', help='Heat values, and as many stay values. Default is 100000', metavar='N',
+                           type=int, default=100000)
+    parser_bn.add_argument('--areas', help='Number of areas. Default is 10', metavar='N', type=int, default=10)
+    parser_bn.add_argument('--rects', help='Number of rectangles. Default is 50', metavar='N', type=int, default=50)
+    parser_bn.add_argument('--days', help='Days covered by the values. Default is 7', metavar='N', type=int, default=7)
+    parser_bn.add_argument('--seed', help='Random seed. Default is 0', metavar='N', type=int, default=0)
+    parser_bn.add_argument('-f', '--format', help='Export format. Default is csv', choices=FORMATS + ['columnar'],
+                           default='csv')
+    parser_bn.add_argument('--database', help='Keep the synthetic database in this file, reuse it when it exists.',
+                           metavar='file')
+    parser_bn.add_argument('--workdir', help='Keep the files written by the scenarios in this directory.',
+                           metavar='path')
+    parser_bn.add_argument('--only', help='Scenarios to run. Default is all', metavar='name', nargs='+')
+    parser_bn.add_argument('-o', '--output', help='Write the results to this json file. Default is stdout',
+                           metavar='file')
+    parser_bn.add_argument('--baseline', help='Results of an earlier run. Exit with 1 when a scenario regressed.',
+                           metavar='file')
+    parser_bn.add_argument('--tolerance', help='Allowed slowdown or memory growth against the baseline. '
+                                               'Default is 0.1', type=float, default=0.1)
+
+    parser_sh.add_argument('--sqlite', help='Path to sqlite database. Default is db.sqlite3', metavar='database')
+    parser_sh.add_argument('--on-conflict', help='Ignore, replace or update-if-newer rows whose id is already in '
+                                                 'a shard. Default is to fail', choices=ON_CONFLICT)
+
+    parser_sv.add_argument('--sqlite', help='Path to sqlite database. Default is db.sqlite3', metavar='database')
+    parser_sv.add_argument('--host', help='Address to listen on. Default is 127.0.0.1', default='127.0.0.1')
+    parser_sv.add_argument('--port', help='Port to listen on. Default is 8000', type=int, default=8000)
+    parser_sv.add_argument('--connections', help='Read-only connections running the queries. Default is 4',
+                           metavar='N', type=int, default=4)
+    parser_sv.add_argument('--cache-size', help='Most answers cached. Default is 10000', metavar='N', type=int,
+                           default=10000)
+    parser_sv.add_argument('--ttl', help='Seconds answers about unfinished hours are cached. Answers about '
+                                         'finished hours are kept until rewritten. Default is 60', metavar='seconds',
+                           type=float, default=60.0)
+    parser_sv.add_argument('--poll', help='Seconds between checks for rewritten report hours. Default is 5',
+                           metavar='seconds', type=float, default=5.0)
+    return parser
+
+
+def main():
+    parser = _parser()
+    args = parser.parse_args()
+    if args.cmd == 'export':
+        if args.hour is not None and args.date is None:
+            parser.error('-t/--hour is an hour of -d/--date')
+        if args.date_to is not None and args.date_from is None:
+            parser.error('--to ends a range started by --from')
+    import registry
+    if registry.run_export(args):
+        return
+    import commands
+    commands.run(args, parser)
+
+
+if __name__ == '__main__':
+    main()